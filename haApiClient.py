@@ -1,63 +1,818 @@
 #! /usr/bin/python3
-from requests import get
 import json
-from urllib.parse import urljoin 
-from rich import print
+from urllib.parse import urljoin, quote
 import time
 import configparser
 import os
+import threading
+import codecs
+import sys
+import re
+import bisect
+import fnmatch
+import csv
+import io
+from datetime import datetime, timezone
+from collections import OrderedDict
+from haWebSocketClient import HaWebSocketClient
+from haHistoryStore import HaHistoryStore
+from haScheduler import HaPollScheduler
+from haMetrics import HaMetrics
+from haLazyModule import LazyModule
+
+# The requests, aiohttp, asyncio and rich libraries take a noticeable time to import, so each is only imported the first time it is needed
+# The aiohttp library is optional. Without it, entities are read one after another instead of concurrently
+aiohttp = LazyModule("aiohttp")
+asyncio = LazyModule("asyncio")
+
+# Pretty-print with rich, which is imported the first time something is printed
+def print(*args, **kwargs):
+    from rich import print as richPrint
+    richPrint(*args, **kwargs)
+
+# Class used to hold the settings for the shared HTTP connection pools
+class HaConnectionSettings:
+    # Initialise the class with sensible defaults for a Home Assistant server on the local network
+    def __init__(self, poolSize=10, keepAlive=True, connectTimeout=3.05, readTimeout=10.0, retries=3, backoffFactor=0.3, stateTtl=1.0, statesTtl=1.0, cacheSize=256, failureThreshold=3, openSeconds=5.0, maxOpenSeconds=60.0, streamStates=False):
+        self.poolSize = poolSize
+        self.keepAlive = keepAlive
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.retries = retries
+        self.backoffFactor = backoffFactor
+        # Seconds that the state of one entity and the states of every entity are reused for, and how many responses are kept
+        self.stateTtl = stateTtl
+        self.statesTtl = statesTtl
+        self.cacheSize = cacheSize
+        # Failures in a row before requests to the server stop, and the shortest and longest time they stop for
+        self.failureThreshold = failureThreshold
+        self.openSeconds = openSeconds
+        self.maxOpenSeconds = maxOpenSeconds
+        # Whether every entity is parsed one at a time as the response arrives when the catalog is read, which uses far less memory on
+        # very large servers but takes several times longer than decoding the whole response at once
+        self.streamStates = streamStates
+
+    # Create the settings from the [Connection] section of a config file, falling back to the defaults for anything missing
+    @classmethod
+    def fromConfig(cls, config):
+        settings = cls()
+        if "Connection" in config:
+            section = config["Connection"]
+            settings.poolSize = section.getint("PoolSize", settings.poolSize)
+            settings.keepAlive = section.getboolean("KeepAlive", settings.keepAlive)
+            settings.connectTimeout = section.getfloat("ConnectTimeout", settings.connectTimeout)
+            settings.readTimeout = section.getfloat("ReadTimeout", settings.readTimeout)
+            settings.retries = section.getint("Retries", settings.retries)
+            settings.backoffFactor = section.getfloat("BackoffFactor", settings.backoffFactor)
+            settings.failureThreshold = section.getint("FailureThreshold", settings.failureThreshold)
+            settings.openSeconds = section.getfloat("OpenSeconds", settings.openSeconds)
+            settings.maxOpenSeconds = section.getfloat("MaxOpenSeconds", settings.maxOpenSeconds)
+            settings.streamStates = section.getboolean("StreamStates", settings.streamStates)
+        if "Cache" in config:
+            section = config["Cache"]
+            settings.stateTtl = section.getfloat("StateTtl", settings.stateTtl)
+            settings.statesTtl = section.getfloat("StatesTtl", settings.statesTtl)
+            settings.cacheSize = section.getint("MaxEntries", settings.cacheSize)
+        return settings
+
+# Class used to reuse recent responses from a server for a few seconds, dropping the least recently used when it is full
+# Identical requests sent while one is already in flight wait for its response rather than being sent again.
+# Responses are shared between callers, so they must not be changed
+class HaResponseCache:
+    #Initialise the class
+    def __init__(self, maxEntries=256):
+        self.maxEntries = maxEntries
+        # Dict of key to (expiry time, result), oldest use first, and dict of key to [finished event, result, error] for requests in flight
+        self.entries = OrderedDict()
+        self.inFlight = {}
+        self.lock = threading.Lock()
+        # Counters of requests answered from the cache, sent to the server and merged into a request already in flight
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+
+    # Return the result of load() for a key, reusing a result less than ttl seconds old or waiting for the same request already in flight
+    # load returns (responseCode, value), and only successful results are kept
+    def fetch(self, key, ttl, load):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            # An expired response is dropped as soon as it is found, as it may be a large list of every state
+            if entry != None:
+                del self.entries[key]
+            flight = self.inFlight.get(key)
+            leader = flight == None
+            if leader:
+                flight = [threading.Event(), None, None]
+                self.inFlight[key] = flight
+                self.misses += 1
+            else:
+                self.merged += 1
+
+        # Wait for the request that is already in flight and share its result
+        if not leader:
+            flight[0].wait()
+            if flight[2] != None:
+                raise flight[2]
+            return flight[1]
+
+        try:
+            flight[1] = load()
+        except Exception as error:
+            flight[2] = error
+            raise
+        finally:
+            with self.lock:
+                self.inFlight.pop(key, None)
+                if flight[2] == None and ttl > 0 and (flight[1][0] == 200 or flight[1][0] == 201):
+                    self.removeExpired()
+                    self.entries[key] = (time.monotonic() + ttl, flight[1])
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.maxEntries:
+                        self.entries.popitem(last=False)
+            flight[0].set()
+        return flight[1]
+
+    # Drop every stored response that has expired. The lock must be held by the caller
+    def removeExpired(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self.entries.items() if entry[0] <= now]:
+            del self.entries[key]
+
+    # Forget every stored response
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # Return the counters and the number of stored responses
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "merged": self.merged, "entries": len(self.entries)}
+
+# Error raised instead of sending a request to a server that has failed too many times in a row
+class HaServerUnavailableError(ConnectionError):
+    pass
+
+# Class used to stop sending requests to a server that keeps failing, so callers fail straight away rather than each waiting for timeouts
+# After failureThreshold failures in a row the circuit opens and requests fail at once for openSeconds. A single trial request is then let through:
+# success closes the circuit again, and failure opens it for twice as long as before, up to maxOpenSeconds.
+# Only the trial request decides what happens to an open circuit, so requests that were already in flight when it opened do not lengthen it
+class HaCircuitBreaker:
+    #Initialise the class
+    def __init__(self, failureThreshold=3, openSeconds=5.0, maxOpenSeconds=60.0):
+        self.failureThreshold = failureThreshold
+        self.openSeconds = openSeconds
+        self.maxOpenSeconds = maxOpenSeconds
+        # Failures in a row, the last error, how long the circuit stays open and when it opened, or None while it is closed
+        self.failures = 0
+        self.lastError = None
+        self.openFor = openSeconds
+        self.openedAt = None
+        # Whether the trial request is in flight, in which case every other request still fails at once
+        self.trialRunning = False
+        self.lock = threading.Lock()
+
+    # Raise HaServerUnavailableError if the circuit is open, letting a single trial request through once it has been open long enough
+    # Returns True for the trial request, which must pass trial to recordSuccess or recordFailure and then call releaseTrial when it finishes
+    def check(self):
+        with self.lock:
+            if self.openedAt == None:
+                return False
+            if self.trialRunning or time.monotonic() < self.openedAt + self.openFor:
+                raise HaServerUnavailableError(f"Server unavailable after {self.failures} failures in a row ({self.lastError}), retrying in {self.retryIn():.0f} s")
+            self.trialRunning = True
+            return True
+
+    # Let another trial request through once the trial request has finished, even if it ended without recording a success or failure,
+    # for example because it was cancelled, so the circuit does not stay half-open for good
+    def releaseTrial(self):
+        with self.lock:
+            self.trialRunning = False
+
+    # Reset the count of failures after a request succeeds, closing the circuit if it was the trial request
+    def recordSuccess(self, trial=False):
+        with self.lock:
+            if trial or self.openedAt == None:
+                self.failures = 0
+                self.openFor = self.openSeconds
+                self.openedAt = None
+
+    # Count a failed request while the circuit is closed, opening it if there have been too many in a row,
+    # or open the circuit again for twice as long if the trial request failed
+    def recordFailure(self, error, trial=False):
+        with self.lock:
+            if trial:
+                self.failures += 1
+                self.lastError = str(error)
+                self.openFor = min(self.maxOpenSeconds, self.openFor * 2)
+                self.openedAt = time.monotonic()
+            elif self.openedAt == None:
+                self.failures += 1
+                self.lastError = str(error)
+                if self.failures >= self.failureThreshold:
+                    self.openedAt = time.monotonic()
+
+    # Return the number of seconds until a trial request is let through, or 0 if requests are being sent
+    def retryIn(self):
+        if self.openedAt == None:
+            return 0
+        return max(0, self.openedAt + self.openFor - time.monotonic())
+
+    # Return "closed" while requests are sent as normal, "open" while they fail at once and "half-open" while the trial request is due or in flight
+    def state(self):
+        with self.lock:
+            if self.openedAt == None:
+                return "closed"
+            if self.trialRunning or self.retryIn() == 0:
+                return "half-open"
+            return "open"
+
+# Class used to share one keep-alive HTTP session between every client that talks to the same server with the same API key
+class HaConnectionPool:
+    # Class variables to store the settings used for new pools and the pools themselves, keyed on server address and API key
+    defaultSettings = HaConnectionSettings()
+    pools = {}
+    poolsLock = threading.Lock()
+
+    # Initialise the class
+    def __init__(self, uri, apiKey, settings=None):
+        self.uri = uri
+        self.settings = settings if settings != None else HaConnectionPool.defaultSettings
+        self.timeout = (self.settings.connectTimeout, self.settings.readTimeout)
+        # Recent responses, shared by every client using the pool
+        self.cache = HaResponseCache(self.settings.cacheSize)
+        # Requests stop for a while when the server keeps failing, for every client using the pool
+        self.breaker = HaCircuitBreaker(self.settings.failureThreshold, self.settings.openSeconds, self.settings.maxOpenSeconds)
+        # The session is created when the first request is sent, so requests is not imported until it is needed
+        self.session = None
+        self.adapter = None
+        self.sessionLock = threading.Lock()
+
+    # Create the pooled session the first time it is used
+    def openSession(self):
+        with self.sessionLock:
+            if self.session == None:
+                from requests import Session
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                # Retry failed connections and gateway errors, waiting a little longer between each attempt
+                retry = Retry(total=self.settings.retries, backoff_factor=self.settings.backoffFactor, status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET"]), raise_on_status=False)
+                self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.settings.poolSize, max_retries=retry)
+                session = Session()
+                session.mount("http://", self.adapter)
+                session.mount("https://", self.adapter)
+                if not self.settings.keepAlive:
+                    session.headers["Connection"] = "close"
+                self.session = session
+        return self.session
+
+    # Return the pool for a server and API key, creating it the first time it is asked for
+    @classmethod
+    def getPool(cls, uri, apiKey, settings=None):
+        with cls.poolsLock:
+            key = (uri, apiKey)
+            if key not in cls.pools:
+                cls.pools[key] = cls(uri, apiKey, settings)
+            return cls.pools[key]
+
+    # Close every pool, for example when the server details are changed
+    @classmethod
+    def closeAll(cls):
+        with cls.poolsLock:
+            for pool in cls.pools.values():
+                if pool.session != None:
+                    pool.session.close()
+            cls.pools = {}
+
+    # Send a GET request through the pooled session, failing at once while the server is unavailable
+    # Connection errors, timeouts and server errors count as failures of the server, while other responses show it is working
+    def get(self, endpoint, headers=None, stream=False, params=None):
+        trial = self.breaker.check()
+        try:
+            try:
+                response = self.openSession().get(endpoint, headers=headers, timeout=self.timeout, stream=stream, params=params)
+            except OSError as error:
+                self.breaker.recordFailure(error, trial)
+                raise
+            if response.status_code >= 500:
+                self.breaker.recordFailure(response.status_code, trial)
+            else:
+                self.breaker.recordSuccess(trial)
+        finally:
+            # The result is recorded before the trial is released, so no other request is let through as a second trial in between
+            if trial:
+                self.breaker.releaseTrial()
+        return response
+
+    # Return how many requests have been sent and how many of them reused an existing connection
+    def connectionStats(self):
+        requestCount = 0
+        connectionCount = 0
+        poolManager = self.adapter.poolmanager if self.adapter != None else None
+        for key in (poolManager.pools.keys() if poolManager != None else []):
+            hostPool = poolManager.pools[key]
+            requestCount += hostPool.num_requests
+            connectionCount += hostPool.num_connections
+        reusedCount = max(0, requestCount - connectionCount)
+        reuseRatio = reusedCount / requestCount if requestCount > 0 else 0.0
+        return {"requests": requestCount, "connections": connectionCount, "reused": reusedCount, "reuseRatio": reuseRatio}
+
+# Class used to pull complete JSON objects out of a JSON array as it arrives, without holding the whole document in memory
+# Objects are returned with the index of the inner array holding them, for documents that are an array of arrays, or -1 otherwise
+class JsonStreamParser:
+    # Patterns to find the characters that change the structure of the document, and to skip over a complete string
+    tokenPattern = re.compile(r'[\[\]{}"]')
+    stringPattern = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+
+    #Initialise the class
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        # Stack of open arrays and objects, where the current top level object started and which inner array it is in
+        self.stack = []
+        self.objectStart = None
+        self.objectDepth = 0
+        self.groupIndex = -1
+
+    # Add more of the document and return a list of (groupIndex, object) for every object completed by it
+    def feed(self, text):
+        self.buffer += text
+        objects = []
+        while True:
+            match = JsonStreamParser.tokenPattern.search(self.buffer, self.position)
+            if match == None:
+                self.position = len(self.buffer)
+                break
+            char = match.group()
+            index = match.start()
+            if char == '"':
+                # Skip the whole string, or wait for more of the document if it has not all arrived
+                stringMatch = JsonStreamParser.stringPattern.match(self.buffer, index)
+                if stringMatch == None:
+                    self.position = index
+                    break
+                self.position = stringMatch.end()
+                continue
+            self.position = index + 1
+            if char == "{" or char == "[":
+                if self.objectStart == None:
+                    if char == "{":
+                        self.objectStart = index
+                        self.objectDepth = len(self.stack)
+                    elif len(self.stack) == 1:
+                        self.groupIndex += 1
+                self.stack.append(char)
+            else:
+                self.stack.pop()
+                if char == "}" and self.objectStart != None and len(self.stack) == self.objectDepth:
+                    objects.append((self.groupIndex, json.loads(self.buffer[self.objectStart:index + 1])))
+                    self.objectStart = None
+        # Drop the part of the document that has been dealt with
+        keep = self.objectStart if self.objectStart != None else self.position
+        self.buffer = self.buffer[keep:]
+        self.position -= keep
+        if self.objectStart != None:
+            self.objectStart = 0
+        return objects
+
+# Class used to hold the few fields of an entity that are needed to list and display it, using __slots__ to keep each record small
+# The full set of attributes is only read from the API when it is asked for
+class HaEntityRecord:
+    __slots__ = ("entity_id", "state", "last_updated", "friendly_name", "unit", "source", "fullAttributes")
+
+    #Initialise the class
+    def __init__(self, entity_id, state=None, last_updated=None, friendly_name=None, unit=None, source=None, fullAttributes=None):
+        self.entity_id = entity_id
+        self.state = state
+        self.last_updated = last_updated
+        self.friendly_name = friendly_name
+        # Units are repeated across many entities, so only one copy of each is kept
+        self.unit = sys.intern(unit) if isinstance(unit, str) else unit
+        # Client used to read the full attributes when they are needed. Its returnState keeps nothing on the client,
+        # so records do not hold on to the response they were read from
+        self.source = source
+        self.fullAttributes = fullAttributes
+
+    # Create a record from a state returned by the API, keeping only the projected fields
+    @classmethod
+    def fromState(cls, state, source=None):
+        attributes = state.get("attributes", {})
+        return cls(state["entity_id"], state.get("state"), state.get("last_updated"), attributes.get("friendly_name"), attributes.get("unit_of_measurement"), source)
+
+    # Return every attribute of the entity, reading them from the API the first time they are asked for
+    @property
+    def attributes(self):
+        if self.fullAttributes == None and self.source != None:
+            responseCode, responseJson = HaApiClient(self.source.uri, pool=self.source.pool, headers=self.source.headers).returnState(self.entity_id)
+            if responseCode == 200 or responseCode == 201:
+                self.fullAttributes = responseJson.get("attributes", {})
+        return self.fullAttributes if self.fullAttributes != None else {}
 
 # Class used to interact directly with the API
 class HaApiClient:
     #Initialise the class
-    def __init__(self,uri="",apiKey=""):
+    def __init__(self,uri="",apiKey="", pool=None, headers=None):
         self.uri = uri
+        # Requests are sent through a connection pool shared with every other client for the same server and key
+        self.pool = pool if pool != None else HaConnectionPool.getPool(uri, apiKey)
         # Headers are used for authentication
-        self.headers = {}
-        self.headers["Authorization"] = f"Bearer {apiKey}"
-        self.headers["content-type"] = "application/json"
+        if headers != None:
+            self.headers = headers
+        else:
+            self.headers = {}
+            self.headers["Authorization"] = f"Bearer {apiKey}"
+            self.headers["content-type"] = "application/json"
         # Store returned data in these variables
         self.data = {}
         self.response = {}
         # Address at the server to provide details about entities and states
         self.getStatesEndpoint = 'api/states'
+        # Address at the server to provide the history of entities
+        self.getHistoryEndpoint = 'api/history/period'
         # Store response code and JSON from the API
         self.responseCode = None
         self.responseJson = None
 
-    # Function the get data from an API endpoint
-    def getRequest(self,endpoint):
-        response = get(endpoint, headers=self.headers)
-        self.response = response
-        self.responseCode = response.status_code
+    # Function the get data from an API endpoint, reusing a response up to ttl seconds old
+    def getRequest(self, endpoint, ttl=0):
+        self.responseCode, self.responseJson = self.fetchJson(endpoint, ttl)
+
+    # Return the response code and JSON from an API endpoint, reusing a response up to ttl seconds old
+    # Nothing is kept on the client, so a long lived client does not hold on to the last response it read
+    def fetchJson(self, endpoint, ttl=0):
+        return self.pool.cache.fetch(("json", endpoint), ttl, lambda: self.sendRequest(endpoint))
+
+    # Send a request to an API endpoint and decode the response, returning the response code and JSON
+    def sendRequest(self, endpoint):
+        with HaMetrics.timer("request"):
+            response = self.pool.get(endpoint, headers=self.headers)
+        responseJson = None
         if response.status_code >= 200 and response.status_code < 400:
-            self.responseJson = json.loads(response.text)
+            with HaMetrics.timer("decode"):
+                responseJson = json.loads(response.text)
+        return response.status_code, responseJson
     
     # Function to get a list of endtityIds from the API 
     def getStates(self):
         endpoint = '/'.join([self.uri,self.getStatesEndpoint])
-        self.getRequest(endpoint)
+        self.getRequest(endpoint, self.pool.settings.statesTtl)
 
     # Function to return the entityIds in a more usable form
     def returnStates(self):
-        self.getStates()
-        return self.responseCode, self.responseJson
+        endpoint = '/'.join([self.uri, self.getStatesEndpoint])
+        return self.fetchJson(endpoint, self.pool.settings.statesTtl)
+
+    # Function to return every entity as a compact HaEntityRecord, parsing the response one entity at a time as it arrives
+    def returnStateRecords(self):
+        endpoint = '/'.join([self.uri, self.getStatesEndpoint])
+        self.responseCode, records = self.pool.cache.fetch(("records", endpoint), self.pool.settings.statesTtl, lambda: self.streamRecords(endpoint))
+        return self.responseCode, records
+
+    # Stream every entity from an endpoint into a list of HaEntityRecords
+    def streamRecords(self, endpoint):
+        responseCode, entityObjects = self.streamObjects(endpoint)
+        return responseCode, [HaEntityRecord.fromState(state, self) for groupIndex, state in entityObjects]
     
     # Function to get the state of an entity from the API
     def getState(self,entity_id):
         endpoint = "/".join([self.uri, self.getStatesEndpoint, entity_id])
-        self.getRequest(endpoint)
+        self.getRequest(endpoint, self.pool.settings.stateTtl)
 
     # Function to return the state of an entity in a more usable form
     def returnState(self, entity_id):
-        self.getState(entity_id)
-        return self.responseCode, self.responseJson
+        endpoint = "/".join([self.uri, self.getStatesEndpoint, entity_id])
+        return self.fetchJson(endpoint, self.pool.settings.stateTtl)
+
+    # Function to stream the JSON objects in a response as they arrive, keeping only one object at a time in memory
+    # Returns the response code and an iterator of (groupIndex, object), which is empty if the request failed.
+    # The time until the response starts is recorded as the request, and the time spent parsing every chunk is added up as decoding
+    def streamObjects(self, endpoint, params=None, chunkSize=65536):
+        with HaMetrics.timer("request"):
+            response = self.pool.get(endpoint, headers=self.headers, stream=True, params=params)
+        if response.status_code < 200 or response.status_code >= 400:
+            response.close()
+            return response.status_code, iter(())
+        return response.status_code, self.parseObjects(response, chunkSize)
+
+    # Parse the JSON objects of a streamed response as each chunk arrives, closing the response once it has all been read
+    def parseObjects(self, response, chunkSize):
+        with response:
+            parser = JsonStreamParser()
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            stopwatch = HaMetrics.stopwatch("decode")
+            for chunk in response.iter_content(chunk_size=chunkSize):
+                stopwatch.start()
+                entityObjects = parser.feed(decoder.decode(chunk))
+                stopwatch.stop()
+                for groupIndex, entityObject in entityObjects:
+                    yield groupIndex, entityObject
+            stopwatch.record()
+
+    # Function to return the recorded history of several entities, one request per batch of entities,
+    # yielding (entity_id, timestamp, state) for each change as it is parsed from the response
+    def iterHistory(self, entityIds, startTime, endTime=None, batchSize=20):
+        startText = datetime.fromtimestamp(startTime, timezone.utc).isoformat()
+        endpoint = "/".join([self.uri, self.getHistoryEndpoint, quote(startText)])
+        for first in range(0, len(entityIds), batchSize):
+            params = {"filter_entity_id": ",".join(entityIds[first:first + batchSize]), "minimal_response": "", "no_attributes": ""}
+            if endTime != None:
+                params["end_time"] = datetime.fromtimestamp(endTime, timezone.utc).isoformat()
+            # Only the first change of each entity includes its entity_id, so remember which inner array belongs to which entity
+            groupEntityIds = {}
+            responseCode, changes = self.streamObjects(endpoint, params)
+            for groupIndex, change in changes:
+                if "entity_id" in change:
+                    groupEntityIds[groupIndex] = change["entity_id"]
+                if groupIndex in groupEntityIds:
+                    yield groupEntityIds[groupIndex], entityTimestamp(change, "last_changed"), change.get("state")
+
+    # Function to return the states of a set of entities from a single request for every state
+    # This is used on every poll, so the response is decoded at once with json.loads, which is much faster than streaming it.
+    # The states are picked out of the same cached response as returnStates, so a poll straight after the catalog is read sends no request
+    def returnStatesFor(self, entityIds):
+        responseCode, responseJson = self.returnStates()
+        wanted = set(entityIds)
+        states = {}
+        if responseJson != None:
+            for entity in responseJson:
+                if entity["entity_id"] in wanted:
+                    states[entity["entity_id"]] = entity
+        return responseCode, states
+
+# Class used to run coroutines from synchronous code on one long-lived event loop, so async sessions stay open between refreshes
+class HaAsyncRunner:
+    # Class variables to store the shared event loop and the thread running it
+    loop = None
+    thread = None
+    lock = threading.Lock()
+
+    # Run a coroutine on the shared loop and wait for its result
+    @classmethod
+    def run(cls, coroutine):
+        with cls.lock:
+            if cls.loop == None:
+                cls.loop = asyncio.new_event_loop()
+                cls.thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+                cls.thread.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, cls.loop).result()
+
+    # Close the shared clients and stop the loop when the program finishes
+    @classmethod
+    def shutdown(cls):
+        if cls.loop != None:
+            for client in list(AsyncHaApiClient.clients.values()):
+                cls.run(client.close())
+            AsyncHaApiClient.clients = {}
+            cls.loop.call_soon_threadsafe(cls.loop.stop)
+            cls.thread.join()
+            cls.loop = None
+
+# Class used to interact with the API without blocking, so many requests can be in flight at once
+class AsyncHaApiClient:
+    # Class variables to store the default limits and the clients shared through HaAsyncRunner
+    defaultConcurrency = 10
+    defaultDeadline = 10.0
+    clients = {}
+    clientsLock = threading.Lock()
+
+    #Initialise the class
+    def __init__(self, uri="", apiKey="", concurrency=None, deadline=None):
+        self.uri = uri
+        # Headers are used for authentication
+        self.headers = {}
+        self.headers["Authorization"] = f"Bearer {apiKey}"
+        self.headers["content-type"] = "application/json"
+        # Address at the server to provide details about entities and states
+        self.getStatesEndpoint = 'api/states'
+        # Limit how many requests are in flight at once and how long each one may take
+        self.concurrency = concurrency if concurrency != None else AsyncHaApiClient.defaultConcurrency
+        self.deadline = deadline if deadline != None else AsyncHaApiClient.defaultDeadline
+        # The session and semaphore are created on first use so that they belong to the running event loop
+        self.session = None
+        self.semaphore = None
+        # Share the circuit breaker of the server's connection pool, so a failing server is treated the same however it is read
+        self.breaker = HaConnectionPool.getPool(uri, apiKey).breaker
+
+    # Return the client for a server and API key that is shared by everything run through HaAsyncRunner
+    @classmethod
+    def getClient(cls, uri, apiKey):
+        with cls.clientsLock:
+            key = (uri, apiKey)
+            if key not in cls.clients:
+                cls.clients[key] = cls(uri, apiKey)
+            return cls.clients[key]
+
+    # Allow the client to be used with "async with" so the session is always closed
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, excType, excValue, traceback):
+        await self.close()
+
+    # Close the session and its connections
+    async def close(self):
+        if self.session != None:
+            await self.session.close()
+            self.session = None
+
+    # Create the session the first time a request is sent
+    def openSession(self):
+        if self.session == None:
+            settings = HaConnectionPool.defaultSettings
+            connector = aiohttp.TCPConnector(limit=self.concurrency, force_close=not settings.keepAlive)
+            timeout = aiohttp.ClientTimeout(sock_connect=settings.connectTimeout, sock_read=settings.readTimeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers)
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    # Function the get data from an API endpoint, returning a 408 response code if it takes longer than the deadline
+    # and a 503 response code if the server cannot be reached or has failed too many times in a row
+    # Any other error, such as a response that is not valid JSON, is counted as a failure and returned as a 502 response code
+    async def getRequest(self, endpoint):
+        self.openSession()
+        try:
+            trial = self.breaker.check()
+        except HaServerUnavailableError:
+            return 503, None
+        try:
+            async with self.semaphore:
+                with HaMetrics.timer("request"):
+                    try:
+                        responseCode, responseJson = await asyncio.wait_for(self.fetch(endpoint), self.deadline)
+                    except asyncio.TimeoutError:
+                        self.breaker.recordFailure("timed out", trial)
+                        return 408, None
+                    except (aiohttp.ClientError, OSError) as error:
+                        self.breaker.recordFailure(error, trial)
+                        return 503, None
+                    except Exception as error:
+                        self.breaker.recordFailure(error, trial)
+                        return 502, None
+            if responseCode >= 500:
+                self.breaker.recordFailure(responseCode, trial)
+            else:
+                self.breaker.recordSuccess(trial)
+            return responseCode, responseJson
+        finally:
+            if trial:
+                self.breaker.releaseTrial()
+
+    # Send the request and decode the response
+    async def fetch(self, endpoint):
+        async with self.session.get(endpoint) as response:
+            if response.status >= 200 and response.status < 400:
+                return response.status, await response.json(content_type=None)
+            return response.status, None
+
+    # Function to return every entity and its state
+    async def returnStates(self):
+        endpoint = '/'.join([self.uri, self.getStatesEndpoint])
+        return await self.getRequest(endpoint)
+
+    # Function to return the state of an entity
+    async def returnState(self, entity_id):
+        endpoint = "/".join([self.uri, self.getStatesEndpoint, entity_id])
+        return await self.getRequest(endpoint)
+
+    # Function to return the state of several entities, requesting them all at once up to the concurrency limit
+    async def returnStatesFor(self, entityIds):
+        responses = await asyncio.gather(*[self.returnState(entityId) for entityId in entityIds])
+        return dict(zip(entityIds, responses))
+
+# Class used to index every entity by its entity_id and its domain, updating in place each time the entities are read
+class HaEntityCatalog:
+    #Initialise the class
+    def __init__(self):
+        # Dict of entity_id to the latest HaEntityRecord read for it, and dict of domain to the set of entity_ids in it
+        self.entities = {}
+        self.domains = {}
+        # Search index built from the entities the first time it is needed after they change
+        self.index = None
+        # Dict of entity_id to the last state read successfully on its own, served as a stale value while the server cannot be read
+        self.lastStates = {}
+        self.lock = threading.Lock()
+
+    # Replace the catalog contents with a fresh list of HaEntityRecords, removing entities that no longer exist
+    # Returns a dict of the entity_ids that were added, removed or renamed, so callers can apply only the differences.
+    # The search index is only rebuilt if one of them changed
+    def update(self, records):
+        with self.lock:
+            added = []
+            renamed = []
+            seenIds = set()
+            for record in records:
+                entityId = record.entity_id
+                seenIds.add(entityId)
+                previous = self.entities.get(entityId)
+                if previous == None:
+                    added.append(entityId)
+                    if "." in entityId:
+                        self.domains.setdefault(entityId.split(".", 1)[0], set()).add(entityId)
+                elif previous.friendly_name != record.friendly_name or previous.unit != record.unit:
+                    renamed.append(entityId)
+                self.entities[entityId] = record
+            removed = [entityId for entityId in self.entities if entityId not in seenIds]
+            for entityId in removed:
+                self.remove(entityId)
+            if len(added) > 0 or len(renamed) > 0:
+                self.index = None
+            return {"added": added, "removed": removed, "renamed": renamed}
+
+    # Remove a single entity and tidy up its domain
+    def remove(self, entityId):
+        self.entities.pop(entityId, None)
+        self.index = None
+        if "." in entityId:
+            domain = entityId.split(".", 1)[0]
+            if domain in self.domains:
+                self.domains[domain].discard(entityId)
+                if len(self.domains[domain]) == 0:
+                    self.domains.pop(domain)
+
+    def __contains__(self, entityId):
+        return entityId in self.entities
+
+    def __len__(self):
+        return len(self.entities)
+
+    # Return the latest record read for an entity, or None if it is not known
+    def get(self, entityId):
+        return self.entities.get(entityId)
+
+    # Return the sorted list of domains
+    # The lock is held while reading, as the catalog can be updated from a background thread
+    def domainNames(self):
+        with self.lock:
+            return sorted(self.domains)
+
+    # Return the sorted entity_ids belonging to any of the given domains
+    def entityIdsForDomains(self, domains):
+        entityIds = []
+        with self.lock:
+            for domain in domains:
+                entityIds.extend(self.domains.get(domain, ()))
+        return sorted(entityIds)
+
+    # Return every record sorted by entity_id
+    def sortedEntities(self):
+        with self.lock:
+            return [self.entities[entityId] for entityId in sorted(self.entities)]
+
+    # Return the search index for the current entities, building it once each time the catalog changes
+    def searchIndex(self):
+        with self.lock:
+            if self.index == None:
+                self.index = HaEntitySearchIndex(self.entities.values())
+            return self.index
+
+# Class used to find entities by the start of any word of their entity_id or friendly name, such as "liv" for sensor.living_room_temperature
+# Each distinct word is kept once in a sorted list, so each search is a binary search for the range of words starting with the text typed
+class HaEntitySearchIndex:
+    # Characters that separate the words of an entity_id, a friendly name or the search text
+    wordSeparators = re.compile(r"[\s._/\-]+")
+
+    #Initialise the class from a list of HaEntityRecords
+    def __init__(self, records):
+        # Dict of each word to the entity_ids using it
+        self.wordEntityIds = {}
+        for record in records:
+            for text in (record.entity_id, record.friendly_name):
+                if text:
+                    for word in HaEntitySearchIndex.wordSeparators.split(text.lower()):
+                        if word in self.wordEntityIds:
+                            self.wordEntityIds[word].append(record.entity_id)
+                        elif word != "":
+                            self.wordEntityIds[word] = [record.entity_id]
+        self.words = sorted(self.wordEntityIds)
+
+    # Return the set of entity_ids with a word starting with each word of the search text. Text with no words matches nothing
+    def search(self, text):
+        matches = None
+        for word in HaEntitySearchIndex.wordSeparators.split(text.lower()):
+            if word == "":
+                continue
+            first = bisect.bisect_left(self.words, word)
+            last = bisect.bisect_left(self.words, word + "\uffff", first)
+            found = set()
+            for index in range(first, last):
+                found.update(self.wordEntityIds[self.words[index]])
+            matches = found if matches == None else matches & found
+            if len(matches) == 0:
+                break
+        return matches if matches != None else set()
 
 # Define a class to essentially format data in a more usable way and provide a way of centrally holding entityIds if more than one instance is defined
 class HaEntityStatus():
-    #Class variables to store all entities and entityIds
-    entities = {}
-    entitiesList = []
+    #Class variable to store the entities of each server, indexed by entity_id and domain, so every instance for a server shares them
+    catalogs = {}
+    catalogsLock = threading.Lock()
+    # Class variable to store the HaCatalogSnapshot each catalog is saved to after it is read, or None to not save them
+    snapshot = None
+    # Class variables controlling when a single request for every state is used instead of one request per entity
+    bulkRatio = 0.02
+    bulkMinimum = 5
     # Initialise the function
     def __init__(self,uri,apiKey, entity_id = ""):
         # Instance variables to store URI, APIKey and entity to query
@@ -66,39 +821,449 @@ class HaEntityStatus():
         self.entity = entity_id
         # Variable to store return code after data is requested
         self.returnCode = 0
+        # Client used for every request, which shares its connections with every other instance for the same server
+        self.apiCall = HaApiClient(uri = self.uri, apiKey = self.apiKey)
+        # Catalog of the server's entities, shared with every other instance for the same server
+        self.catalog = HaEntityStatus.catalogFor(self.uri)
+        # Entities added, removed or renamed by the last readAllEntities
+        self.changes = {"added": [], "removed": [], "renamed": []}
+
+    # Return the catalog of a server's entities, creating it the first time the server is used
+    @classmethod
+    def catalogFor(cls, uri):
+        with cls.catalogsLock:
+            return cls.catalogs.setdefault(uri.rstrip("/"), HaEntityCatalog())
+
+    # Function to return how well connections to the server are being reused
+    def connectionStats(self):
+        return self.apiCall.pool.connectionStats()
+
+    # Function to return how many requests were answered from the cache or merged with one already in flight
+    def cacheStats(self):
+        return self.apiCall.pool.cache.stats()
+
+    # Function to return whether requests to the server are being sent ("closed"), have stopped after failures ("open") or are being retried ("half-open")
+    def circuitState(self):
+        return self.apiCall.pool.breaker.state()
 
     # Function to read all entities from the API and format data
-    def readAllEntities(self):
-        apiCall = HaApiClient(uri = self.uri, apiKey = self.apiKey)
-        entities = apiCall.returnStates()
-        self.responseCode = apiCall.responseCode
-        # Make sure the return code shows success before going further
-        if entities[0] == 200 or entities[0] == 201:
-            # Add entities to a class variable to allow all instances to refer to the data
-            HaEntityStatus.entities = entities[1]
-            #Now return a list of just the entity IDs and store in a class variable
-            for entity in entities[1]:
-                HaEntityStatus.entitiesList.append(entity["entity_id"])
-    
-    # Request the state of a single entityId and return if possible
+    # When streaming, entities are parsed one at a time as the response arrives and only their projected fields are kept.
+    # Streaming is only used if asked for, or turned on by StreamStates in the [Connection] section of the config file
+    def readAllEntities(self, streaming=None):
+        with HaMetrics.timer("catalog.load"):
+            apiCall = self.apiCall
+            if streaming == None:
+                streaming = apiCall.pool.settings.streamStates
+            if streaming:
+                entities = apiCall.returnStateRecords()
+            else:
+                entities = apiCall.returnStates()
+            self.responseCode = entities[0]
+            # Make sure the return code shows success before going further
+            if entities[0] == 200 or entities[0] == 201:
+                records = entities[1] if streaming else [HaEntityRecord.fromState(state, apiCall) for state in entities[1]]
+                # Update the catalog shared by every instance for the server to allow all of them to refer to the data
+                with HaMetrics.timer("catalog.update"):
+                    self.changes = self.catalog.update(records)
+                self.saveSnapshot()
+
+    # Save the changes from the last readAllEntities to the snapshot, if there is one
+    def saveSnapshot(self):
+        if HaEntityStatus.snapshot != None:
+            with HaMetrics.timer("catalog.save"):
+                HaEntityStatus.snapshot.save(self.uri, self.catalog, self.changes)
+
+    # Fill the catalog from the snapshot if it has not been read yet, so its entities can be listed before the server answers
+    def loadSnapshot(self):
+        if HaEntityStatus.snapshot != None and len(self.catalog) == 0:
+            with HaMetrics.timer("catalog.restore"):
+                self.catalog.update(HaEntityStatus.snapshot.load(self.uri, self.apiCall))
+
+    # Request the state of a single entityId and return it, or the response code if it could not be read
+    # Unknown entities are returned with a 404 response code, servers that cannot be reached with a 503 response code
+    # and responses that are not valid JSON with a 502 response code
     def readEntity(self, entity_id = ""):
         if self.entity == "":
             self.entity = entity_id
 
-        #Check to see if the entity_id exists in the list of entities
-        if self.entity in HaEntityStatus.entitiesList:
-            apiCall = HaApiClient(uri = self.uri, apiKey = self.apiKey)
-            entity = apiCall.returnState(self.entity)
-            # Format the data accordingly, based on success or failure from the API
-            if entity[0] == 200 or entity[0] == 201:
-                return {"responseCode":entity[0], "responseJson": entity[1]}
-            if entity[0] > 201:
-                return {"responseCode":entity[0], "responseJson": {}}
+        #Check to see if the entity_id exists in the list of entities, unless the entities have not been read yet
+        if len(self.catalog) > 0 and self.entity not in self.catalog:
+            return {"responseCode": 404, "responseJson": {}}
+        try:
+            entity = self.apiCall.returnState(self.entity)
+        except OSError as error:
+            return self.failedResult(self.entity, 503, error)
+        except ValueError as error:
+            return self.failedResult(self.entity, 502, error)
+        return self.formatResult(self.entity, entity[0], entity[1])
+
+    # Read the recorded history of several entities over the last few hours, yielding (entity_id, timestamp, state) as it is parsed
+    def readHistory(self, entityIds, hours):
+        return self.apiCall.iterHistory(list(entityIds), time.time() - hours * 3600)
+
+    # Decide whether a single request for every state is cheaper than one request per entity
+    def useBulkRead(self, entityCount):
+        if entityCount < HaEntityStatus.bulkMinimum:
+            return False
+        totalCount = len(self.catalog)
+        if totalCount == 0:
+            return True
+        return entityCount / totalCount >= HaEntityStatus.bulkRatio
+
+    # Request the state of several entityIds at once, returning a dict of results in the same format as readEntity
+    def readEntities(self, entityIds):
+        results = {}
+        if self.useBulkRead(len(entityIds)):
+            try:
+                responseCode, states = self.apiCall.returnStatesFor(entityIds)
+            except OSError as error:
+                return {entityId: self.failedResult(entityId, 503, error) for entityId in entityIds}
+            except ValueError as error:
+                return {entityId: self.failedResult(entityId, 502, error) for entityId in entityIds}
+            for entityId in entityIds:
+                if entityId in states:
+                    results[entityId] = self.formatResult(entityId, responseCode, states[entityId])
+                elif responseCode == 200 or responseCode == 201:
+                    results[entityId] = {"responseCode": 404, "responseJson": {}}
+                else:
+                    results[entityId] = self.failedResult(entityId, responseCode)
+        elif aiohttp.isAvailable():
+            results = self.readEntitiesConcurrently(entityIds)
         else:
-            print("Entity does not exist")
+            for entityId in entityIds:
+                results[entityId] = HaEntityStatus(self.uri, self.apiKey, entityId).readEntity()
+        return results
+
+    # Format the response for an entity in the same way as readEntity, remembering the state if it was read successfully and serving the last good state if the server failed
+    def formatResult(self, entityId, responseCode, responseJson):
+        if responseCode == 200 or responseCode == 201:
+            self.catalog.lastStates[entityId] = responseJson
+            return {"responseCode": responseCode, "responseJson": responseJson}
+        return self.failedResult(entityId, responseCode)
+
+    # Return the result for an entity that could not be read. If the server failed or could not be reached, the last state read successfully
+    # is returned as well, marked as stale, with the response code still showing the error
+    def failedResult(self, entityId, responseCode, error=None):
+        result = {"responseCode": responseCode, "responseJson": {}}
+        if error != None:
+            result["error"] = str(error)
+        if (responseCode >= 500 or responseCode == 408) and entityId in self.catalog.lastStates:
+            result["responseJson"] = self.catalog.lastStates[entityId]
+            result["stale"] = True
+        return result
+
+    # Async version of readAllEntities
+    async def readAllEntitiesAsync(self, client):
+        responseCode, responseJson = await client.returnStates()
+        self.responseCode = responseCode
+        if responseCode == 200 or responseCode == 201:
+            self.changes = self.catalog.update([HaEntityRecord.fromState(state, self.apiCall) for state in responseJson])
+            self.saveSnapshot()
+
+    # Async version of readEntity
+    async def readEntityAsync(self, client, entity_id = ""):
+        if self.entity == "":
+            self.entity = entity_id
+        if len(self.catalog) == 0 or self.entity in self.catalog:
+            return self.formatResult(self.entity, *await client.returnState(self.entity))
+        return {"responseCode": 404, "responseJson": {}}
+
+    # Read several entities at once, sending the requests concurrently up to the client's concurrency limit
+    async def readEntitiesAsync(self, entityIds, client=None):
+        if client == None:
+            async with AsyncHaApiClient(self.uri, self.apiKey) as client:
+                return await self.readEntitiesAsync(entityIds, client)
+        knownIds = [entityId for entityId in entityIds if len(self.catalog) == 0 or entityId in self.catalog]
+        responses = await client.returnStatesFor(knownIds)
+        results = {}
+        for entityId in entityIds:
+            if entityId in responses:
+                results[entityId] = self.formatResult(entityId, *responses[entityId])
+            else:
+                results[entityId] = {"responseCode": 404, "responseJson": {}}
+        return results
+
+    # Synchronous wrapper around readEntitiesAsync, so the GUI and CLI can read entities concurrently
+    def readEntitiesConcurrently(self, entityIds):
+        client = AsyncHaApiClient.getClient(self.uri, self.apiKey)
+        return HaAsyncRunner.run(self.readEntitiesAsync(entityIds, client))
+
+# Return the name used for an entity when the entities of several servers are listed together
+# Entities of the first server keep their entity_id, and those of other servers are named "server/entity_id"
+def qualifyEntityId(serverName, entityId):
+    if serverName == "":
+        return entityId
+    return serverName + "/" + entityId
+
+# Split a name from qualifyEntityId into the server name and the entity_id
+def splitEntityId(qualifiedId):
+    if "/" in qualifiedId:
+        serverName, entityId = qualifiedId.split("/", 1)
+        return serverName, entityId
+    return "", qualifiedId
+
+# Class used to hold the details of one Home Assistant server. Each server has its own connection pool and catalog of entities
+class HaServer:
+    #Initialise the class
+    def __init__(self, name, uri, apiKey):
+        self.name = name
+        self.uri = uri
+        self.apiKey = apiKey
+        # Used to read every entity of the server and to decide how its entities are read together
+        self.entityStatus = HaEntityStatus(uri, apiKey)
+        self.catalog = self.entityStatus.catalog
+
+    # Return a new HaEntityStatus for reading one of the server's entities
+    def entity(self, entityId):
+        return HaEntityStatus(self.uri, self.apiKey, entityId)
+
+# Class used to hold every configured server and list their entities together, named as by qualifyEntityId
+class HaServerGroup:
+    #Initialise the class
+    def __init__(self):
+        # Dict of server name to HaServer, in the order they were configured. The first server is named ""
+        self.servers = {}
+
+    # Create the group from the config file. The [Server] section holds the first server and each [Server:name] section another one
+    # The address and API key of the first server can be given instead, for example when they were typed in
+    @classmethod
+    def fromConfig(cls, config, uri=None, apiKey=None):
+        group = cls()
+        section = config["Server"] if "Server" in config else {}
+        group.setServer("", uri if uri != None else section.get("Address", ""), apiKey if apiKey != None else section.get("ApiKey", ""))
+        for sectionName in config.sections():
+            if sectionName.startswith("Server:"):
+                name = sectionName[len("Server:"):].strip()
+                if name == "" or "/" in name or "Address" not in config[sectionName] or "ApiKey" not in config[sectionName]:
+                    print(f"Ignoring the [{sectionName}] section, which needs a name without a / and both an Address and an ApiKey")
+                    continue
+                group.setServer(name, config[sectionName]["Address"], config[sectionName]["ApiKey"])
+        return group
+
+    # Add a server, or change the address or API key of one, returning its HaServer
+    def setServer(self, name, uri, apiKey):
+        server = self.servers.get(name)
+        if server == None or server.uri != uri or server.apiKey != apiKey:
+            server = HaServer(name, uri, apiKey)
+            self.servers[name] = server
+        return server
+
+    def __iter__(self):
+        return iter(self.servers.values())
+
+    def __len__(self):
+        return len(self.servers)
+
+    # Return the server with a name, or None if there is no such server
+    def get(self, name):
+        return self.servers.get(name)
+
+    # Return the server and entity_id of a qualified entity name, with None for the server if it is not configured
+    def find(self, qualifiedId):
+        serverName, entityId = splitEntityId(qualifiedId)
+        return self.servers.get(serverName), entityId
+
+    def __contains__(self, qualifiedId):
+        server, entityId = self.find(qualifiedId)
+        return server != None and entityId in server.catalog
+
+    # Fill the catalog of every server that has not been read yet from the snapshot
+    def loadSnapshot(self):
+        for server in self:
+            server.entityStatus.loadSnapshot()
+
+    # Read the entities of every server at once, so a slow server does not hold up the others
+    # Returns a dict of server name to the response code, or to the exception raised if the server could not be reached.
+    # If onServerRead is given, it is called with each server and its result as soon as that server has been read, from the thread reading it
+    def readAllEntities(self, onServerRead=None):
+        results = {}
+        def readServer(server):
+            try:
+                server.entityStatus.readAllEntities()
+                results[server.name] = server.entityStatus.responseCode
+            except Exception as error:
+                results[server.name] = error
+            if onServerRead != None:
+                onServerRead(server, results[server.name])
+        threads = [threading.Thread(target=readServer, args=(server,), daemon=True) for server in self]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    # Return the sorted list of domains found on any server
+    def domainNames(self):
+        domains = set()
+        for server in self:
+            domains.update(server.catalog.domainNames())
+        return sorted(domains)
+
+    # Return the qualified names of the entities belonging to any of the given domains, server by server
+    def entityIdsForDomains(self, domains):
+        entityIds = []
+        for server in self:
+            entityIds.extend(qualifyEntityId(server.name, entityId) for entityId in server.catalog.entityIdsForDomains(domains))
+        return entityIds
+
+    # Return the set of qualified names of the entities matching search text on any server
+    def search(self, text):
+        matches = set()
+        for server in self:
+            matches.update(qualifyEntityId(server.name, entityId) for entityId in server.catalog.searchIndex().search(text))
+        return matches
+
+# Return the time an entity was last updated as seconds since the epoch, or the current time if the API did not provide it
+def entityTimestamp(entityJson, field="last_updated"):
+    try:
+        return datetime.fromisoformat(entityJson[field]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+# Read the entities that are due, calling onResult with (entity_id, response, changed) for each and scheduling their next poll
+# lastUpdated is a dict of entity_id to the last_updated time last seen, used to tell whether each entity has changed
+def pollDueEntities(entityStatus, scheduler, lastUpdated, onResult):
+    dueEntityIds = scheduler.takeDue(bulkRead=entityStatus.useBulkRead)
+    if len(dueEntityIds) == 0:
+        return 0
+    responses = entityStatus.readEntities(dueEntityIds)
+    # Entities read together are scheduled from the same time, so they stay due together while their intervals match
+    now = time.monotonic()
+    for entityId in dueEntityIds:
+        response = responses[entityId]
+        success = response["responseCode"] == 200 or response["responseCode"] == 201
+        changed = success and response["responseJson"].get("last_updated") != lastUpdated.get(entityId)
+        if success:
+            lastUpdated[entityId] = response["responseJson"].get("last_updated")
+        onResult(entityId, response, changed)
+        scheduler.recordResult(entityId, changed, error=not success, now=now)
+    return len(dueEntityIds)
+
+# Return the entity_ids matching a list of entity_ids and patterns such as "sensor.*", in the order given and without repeats
+def expandEntityPatterns(patterns, catalog):
+    entityIds = {}
+    for pattern in patterns:
+        if any(character in pattern for character in "*?["):
+            for entityId in sorted(catalog.entities):
+                if fnmatch.fnmatchcase(entityId, pattern):
+                    entityIds[entityId] = True
+        elif pattern in catalog:
+            entityIds[pattern] = True
+        else:
+            print(f"Entity {pattern} does not exist", file=sys.stderr)
+    return list(entityIds)
+
+# Class used to write entity states as JSON lines or CSV rows, holding them in memory until flush is called
+class HaStateWriter:
+    # Class variable to store the fields written for each state, which are also the CSV columns
+    fields = ["time", "entity_id", "state", "unit", "friendly_name", "status"]
+
+    #Initialise the class, writing a CSV header if asked to
+    def __init__(self, stream, format="jsonl", writeHeader=True):
+        self.stream = stream
+        self.format = format
+        self.buffer = io.StringIO()
+        # States may be written from the thread receiving pushed changes as well as the polling loop
+        self.lock = threading.Lock()
+        if format == "csv":
+            self.csvWriter = csv.writer(self.buffer)
+            if writeHeader:
+                self.csvWriter.writerow(HaStateWriter.fields)
+
+    # Add the state of an entity, or the response code if it could not be read
+    def write(self, entityId, responseCode, entityJson):
+        attributes = entityJson.get("attributes", {})
+        row = [entityJson.get("last_updated", datetime.now(timezone.utc).isoformat()), entityId, entityJson.get("state"), attributes.get("unit_of_measurement"), attributes.get("friendly_name"), responseCode]
+        with self.lock:
+            if self.format == "csv":
+                self.csvWriter.writerow(row)
+            else:
+                self.buffer.write(json.dumps(dict(zip(HaStateWriter.fields, row))) + "\n")
+
+    # Write everything held so far to the stream in one go
+    def flush(self):
+        with self.lock:
+            text = self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        if text != "":
+            self.stream.write(text)
+            self.stream.flush()
+
+# Watch entities without prompting, writing their states to a HaStateWriter until the duration in seconds is up, or forever
+# Entities are read together on the scheduler's timetable, using a single request or concurrent requests, and pushed changes are written as they arrive.
+# While changes are pushed, polling stops unless keepPolling is True, for example so a state is still written at a fixed interval
+def watchEntities(uri, apiKey, patterns, writer, scheduler, changesOnly=False, duration=None, historyStore=None, keepPolling=False):
+    allEntities = HaEntityStatus(uri, apiKey)
+    allEntities.readAllEntities()
+    if allEntities.responseCode != 200 and allEntities.responseCode != 201:
+        raise ConnectionError(f"Could not read the entities from the server: {allEntities.responseCode}")
+    entityIds = expandEntityPatterns(patterns, allEntities.catalog)
+    if len(entityIds) == 0:
+        raise ValueError("No entities match " + " ".join(patterns))
+    scheduler.setEntities(entityIds)
+    trackedEntityIds = set(entityIds)
+    lastUpdated = {}
+
+    # Write a state and keep it in the history store, if there is one
+    def writeState(entityId, response, changed):
+        if changed or not changesOnly:
+            writer.write(entityId, response["responseCode"], response["responseJson"])
+        if changed and historyStore != None:
+            historyStore.addSample(entityId, entityTimestamp(response["responseJson"]), response["responseJson"]["state"])
+
+    # Write changes pushed from the server as soon as they arrive
+    def writePushedState(entityId, newState):
+        if entityId in trackedEntityIds and newState != None:
+            lastUpdated[entityId] = newState.get("last_updated")
+            writeState(entityId, {"responseCode": 200, "responseJson": newState}, True)
+            writer.flush()
+    pushClient = HaWebSocketClient(uri, apiKey, onStateChanged=writePushedState)
+    pushClient.start()
+
+    endTime = None if duration == None else time.monotonic() + duration
+    try:
+        while endTime == None or time.monotonic() < endTime:
+            if keepPolling or not pushClient.connected:
+                if pollDueEntities(allEntities, scheduler, lastUpdated, writeState) > 0:
+                    writer.flush()
+            # Check again at least every second, so polling starts promptly if the pushed updates stop
+            dueIn = scheduler.nextDueIn()
+            wait = 1 if dueIn == None else min(1, dueIn)
+            if endTime != None:
+                wait = min(wait, max(0, endTime - time.monotonic()))
+            time.sleep(wait)
+    finally:
+        pushClient.stop()
+        HaAsyncRunner.shutdown()
+        writer.flush()
+
+# Apply the [Connection] and [Polling] sections of a config file to the client classes
+def applyClientSettings(config):
+    HaConnectionPool.defaultSettings = HaConnectionSettings.fromConfig(config)
+    if "Polling" in config:
+        HaEntityStatus.bulkRatio = config["Polling"].getfloat("BulkRatio", HaEntityStatus.bulkRatio)
+        HaEntityStatus.bulkMinimum = config["Polling"].getint("BulkMinimum", HaEntityStatus.bulkMinimum)
+        AsyncHaApiClient.defaultConcurrency = config["Polling"].getint("Concurrency", AsyncHaApiClient.defaultConcurrency)
+        AsyncHaApiClient.defaultDeadline = config["Polling"].getfloat("RequestDeadline", AsyncHaApiClient.defaultDeadline)
 
 # Only run the code if called directly
 if __name__ == '__main__':
+    import argparse
+
+    # Entities given on the command line are watched without prompting, otherwise they are chosen interactively
+    parser = argparse.ArgumentParser(description="Read entity states from a Home Assistant server. If no entities are given, they are chosen interactively.")
+    parser.add_argument("entities", nargs="*", help="entity_ids or patterns such as 'sensor.*' to watch, writing their states to standard output or a file")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl", help="write a JSON object or a CSV row for each state (default jsonl)")
+    parser.add_argument("--output", help="append the states to this file instead of writing them to standard output")
+    parser.add_argument("--interval", type=float, help="poll and write every entity this many seconds apart, even while changes are pushed by the server, "
+                        "instead of more often when it changes and less often when it does not")
+    parser.add_argument("--changes-only", action="store_true", help="only write states that have changed since they were last read. "
+                        "Without --interval, only changes are written while the server pushes them, as entities are not polled then")
+    parser.add_argument("--duration", type=float, help="stop watching after this many seconds")
+    parser.add_argument("--server", help="server address, instead of the one in the config file")
+    parser.add_argument("--api-key", help="API key, instead of the one in the config file")
+    args = parser.parse_args()
 
     # Variables to hold the URI and API keys
     uri = None
@@ -115,8 +1280,46 @@ if __name__ == '__main__':
             uri = config["Server"]["Address"]
         if "Server" in config and "ApiKey" in config["Server"]:
             apiKey = config["Server"]["ApiKey"]
-    else:
+        applyClientSettings(config)
+        HaMetrics.configure(config)
+    elif len(args.entities) == 0:
         print("Config file does not exist or is incorrectly formatted! You will be asked to enter details next...")
+    if args.server != None:
+        uri = args.server
+    if args.api_key != None:
+        apiKey = args.api_key
+
+    # Watch the entities given on the command line until the duration is up or Ctrl+C is pressed
+    if len(args.entities) > 0:
+        if uri == None or apiKey == None:
+            parser.error("the server address and API key must be in the config file or given with --server and --api-key")
+        if args.interval != None:
+            scheduler = HaPollScheduler(minInterval=args.interval, maxInterval=args.interval, requestsPerSecond=0, jitter=0)
+            # Keep cached responses for less than the interval, or polls would repeat the value read last time
+            settings = HaConnectionPool.defaultSettings
+            settings.stateTtl = min(settings.stateTtl, args.interval / 2)
+            settings.statesTtl = min(settings.statesTtl, args.interval / 2)
+        else:
+            scheduler = HaPollScheduler.fromConfig(config)
+        if args.output != None:
+            outputFile = open(args.output, "a", newline="", buffering=1 << 16)
+        else:
+            outputFile = sys.stdout
+        writer = HaStateWriter(outputFile, args.format, writeHeader=outputFile.tell() == 0 if args.output != None else True)
+        historyStore = HaHistoryStore.fromConfig(config)
+        try:
+            watchEntities(uri, apiKey, args.entities, writer, scheduler, args.changes_only, args.duration, historyStore, keepPolling=args.interval != None)
+        except KeyboardInterrupt:
+            pass
+        except (OSError, ValueError) as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
+        finally:
+            if historyStore != None:
+                historyStore.close()
+            if outputFile != sys.stdout:
+                outputFile.close()
+        sys.exit(0)
 
     # If the config file does not exist or is incorrectly formatted, request the user to enter the URI and / or API Key
     if uri == None:
@@ -127,16 +1330,15 @@ if __name__ == '__main__':
     # Request all entities from the API
     allEntities = HaEntityStatus(uri, apiKey)
     allEntities.readAllEntities()
-    entitiesJson = allEntities.entities
 
-    # Sort the returned data 
-    entitiesJson = sorted(entitiesJson, key=lambda x:x['entity_id'])
+    # Get the returned data sorted by entity_id
+    entitiesJson = allEntities.catalog.sortedEntities()
 
     # Print a list of all of the entities of type sensor along with a number that can be used to refer to them
     counter = 0
     for entity in entitiesJson:
-        if entity["entity_id"][0:7] == 'sensor.':
-            print(counter, entity["entity_id"])
+        if entity.entity_id[0:7] == 'sensor.':
+            print(counter, entity.entity_id)
         counter += 1
 
     # Create a list to store any items that we want to check
@@ -153,14 +1355,52 @@ if __name__ == '__main__':
         # Add the number entered to the entity list and create a reference to an instance of the HaEntityStatus class that can be called multiple times to return new data
         try:
             entityList.append(int(a))
-            entityObjects.append(HaEntityStatus(uri, apiKey, entity_id=entitiesJson[int(a)]['entity_id']))
+            entityObjects.append(HaEntityStatus(uri, apiKey, entity_id=entitiesJson[int(a)].entity_id))
         except:
             print("Please try again")
 
-    # Now, each time the loop runs, iterate through our list of entity IDs and HaEntityStatus items and return an updated number. Finally, sleep for ten seconds before repeating
+    # Keep a history of every value read, so it can be looked back on later
+    historyStore = HaHistoryStore.fromConfig(config)
+    def recordState(entityId, state):
+        if historyStore != None:
+            historyStore.addSample(entityId, entityTimestamp(state), state["state"])
+
+    # Print changes pushed from the server for the tracked entities as soon as they arrive
+    trackedEntityIds = set(entityObject.entity for entityObject in entityObjects)
+    def printPushedState(entityId, newState):
+        if entityId in trackedEntityIds and newState != None:
+            print(200, newState["attributes"].get("friendly_name", entityId), newState["state"])
+            recordState(entityId, newState)
+    pushClient = HaWebSocketClient(uri, apiKey, onStateChanged=printPushedState)
+    pushClient.start()
+
+    # Each entity is polled on its own schedule, sooner when it changes and later when it does not
+    scheduler = HaPollScheduler.fromConfig(config)
+    scheduler.setEntities(trackedEntityIds)
+    lastUpdated = {}
+
+    # Print a value that has been read, or the response code if it could not be read. Only values that have changed are saved,
+    # as an unchanged value has the same last_updated time as the sample already saved
+    def printState(entityId, response, changed):
+        if response["responseCode"] == 200 or response["responseCode"] == 201:
+            print(response["responseCode"], response["responseJson"]["attributes"].get("friendly_name", entityId), response["responseJson"]["state"])
+            if changed:
+                recordState(entityId, response["responseJson"])
+        elif response.get("stale"):
+            # The server could not be read, so show the last value read and say that it is out of date
+            print(response["responseCode"], response["responseJson"]["attributes"].get("friendly_name", entityId), response["responseJson"]["state"], "(stale)")
+        else:
+            print(response["responseCode"], entityId)
+
+    # Now, each time the loop runs, read the entities that are due and print their updated values, unless changes are being pushed. Finally, sleep until the next entity is due
     while 1:
-        # Now print the entries
-        for entityObject in entityObjects:
-            response = entityObject.readEntity()
-            print(response["responseCode"], response["responseJson"]["attributes"]["friendly_name"], response["responseJson"]["state"])
-        time.sleep(10)
\ No newline at end of file
+        if not pushClient.connected:
+            # Now print the entries, fetching them all together so a single request can be used when many are due
+            if pollDueEntities(allEntities, scheduler, lastUpdated, printState) > 0:
+                # Show how many requests were able to reuse an already open connection
+                stats = allEntities.connectionStats()
+                cacheStats = allEntities.cacheStats()
+                print(f"Requests: {stats['requests']}, connections opened: {stats['connections']}, reused: {stats['reuseRatio']:.0%}, cache hits: {cacheStats['hits']}, merged: {cacheStats['merged']}")
+        # Check again at least every second, so polling starts promptly if the pushed updates stop
+        dueIn = scheduler.nextDueIn()
+        time.sleep(1 if dueIn == None else min(1, dueIn))
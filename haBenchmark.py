@@ -0,0 +1,289 @@
+#! /usr/bin/python3
+# Benchmark the API client and the GUI refresh against a local stub of the Home Assistant REST API
+# Results are printed and can be saved as JSON, then compared with the results of an earlier version using --compare
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import threading
+import subprocess
+import tracemalloc
+import urllib.request
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, unquote
+
+from haApiClient import HaApiClient, HaEntityStatus, HaConnectionPool, HaConnectionSettings, HaAsyncRunner
+from haScheduler import HaPollScheduler
+from haMetrics import HaMetrics
+from haRollingStats import RollingStatistics
+
+# Request handler for the stub server, which answers from the entities held by the server it belongs to
+class HaStubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send the headers and body of each response together, so small responses are not held up waiting for acknowledgements
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    # Keep the benchmark output free of a line for every request
+    def log_message(self, format, *args):
+        pass
+
+    # Answer a GET request after the configured latency, failing it at the configured error rate
+    def do_GET(self):
+        stub = self.server.stub
+        path = unquote(urlparse(self.path).path)
+        # The number of requests answered so far, asked for by the benchmark when the stub runs in another process
+        if path == "/stub/requests":
+            self.sendJson(200, {"requests": stub.requestCount})
+            return
+        stub.countRequest()
+        if stub.latency > 0:
+            time.sleep(stub.latency)
+        if stub.errorRate > 0 and random.random() < stub.errorRate:
+            self.sendJson(500, {"message": "Stub server error"})
+        elif path == "/api/states":
+            self.sendJson(200, [stub.state(entityId) for entityId in stub.entityIds])
+        elif path.startswith("/api/states/"):
+            entityId = path[len("/api/states/"):]
+            if entityId in stub.entityIndex:
+                self.sendJson(200, stub.state(entityId))
+            else:
+                self.sendJson(404, {"message": "Entity not found."})
+        elif path.startswith("/api/history/period"):
+            self.sendJson(200, [])
+        else:
+            self.sendJson(404, {"message": "Not found"})
+
+    # Send an object as a JSON response
+    def sendJson(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+# Class used to run a stub Home Assistant server on a local port in a background thread
+class HaStubServer:
+    #Initialise the class with the number of entities, the size of each entity's attributes in bytes, the latency in seconds and the fraction of requests that fail
+    def __init__(self, entityCount=1000, payloadSize=200, latency=0.0, errorRate=0.0):
+        self.entityIds = [f"sensor.benchmark_{index}" for index in range(entityCount)]
+        self.entityIndex = set(self.entityIds)
+        self.padding = "x" * payloadSize
+        self.latency = latency
+        self.errorRate = errorRate
+        self.requestCount = 0
+        self.countLock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), HaStubRequestHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.uri = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = None
+
+    # Return a state for an entity with a new value each time, as a busy server would
+    def state(self, entityId):
+        now = datetime.now(timezone.utc).isoformat()
+        return {"entity_id": entityId, "state": f"{random.uniform(0, 100):.2f}", "last_changed": now, "last_updated": now,
+                "attributes": {"friendly_name": entityId.replace("_", " "), "unit_of_measurement": "°C", "padding": self.padding}}
+
+    def countRequest(self):
+        with self.countLock:
+            self.requestCount += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# Class used to run the stub server in a separate process, so the memory and time it uses to build responses are not counted against the client.
+# It is started by running this program with --serve, which prints the address of the server once it is listening
+class HaStubProcess:
+    #Initialise the class with the same settings as HaStubServer
+    def __init__(self, entityCount=1000, payloadSize=200, latency=0.0, errorRate=0.0):
+        self.entityIds = [f"sensor.benchmark_{index}" for index in range(entityCount)]
+        self.arguments = ["--entities", str(entityCount), "--payload", str(payloadSize), "--latency", str(latency), "--error-rate", str(errorRate)]
+        self.process = None
+        self.uri = None
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve"] + self.arguments, stdout=subprocess.PIPE, text=True)
+        self.uri = self.process.stdout.readline().strip()
+        if self.uri == "":
+            raise RuntimeError("The stub server did not start")
+        return self
+
+    # Return the number of requests the stub server has answered
+    @property
+    def requestCount(self):
+        with urllib.request.urlopen(self.uri + "/stub/requests") as response:
+            return json.load(response)["requests"]
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+# Return the value at a fraction of the way through a sorted list of numbers
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+# Call a function a number of times, returning the latency percentiles in milliseconds and the requests per second seen by the server
+# Peak memory is measured on one further call, as tracing memory slows every call down
+def benchmark(stub, function, runs):
+    function()
+    latencies = []
+    firstRequest = stub.requestCount
+    start = time.perf_counter()
+    for run in range(runs):
+        callStart = time.perf_counter()
+        function()
+        latencies.append((time.perf_counter() - callStart) * 1000)
+    elapsed = time.perf_counter() - start
+    requests = stub.requestCount - firstRequest
+
+    tracemalloc.start()
+    function()
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"runs": runs, "requests": requests, "requestsPerSecond": requests / elapsed if elapsed > 0 else None,
+            "p50Ms": percentile(latencies, 0.5), "p99Ms": percentile(latencies, 0.99), "peakMemoryKb": peakMemory / 1024}
+
+# Benchmark a cycle of MainWindow.updateTableValues on an offscreen display: reading the tracked entities in the background,
+# applying the values and redrawing the table. Render time is the time taken to paint the window once the values are applied
+def benchmarkMainWindow(stub, trackedCount, runs):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication
+    import qtHaGui
+
+    app = QApplication.instance() or QApplication([])
+    # Every entity is due on every cycle, so each cycle does the same amount of work, including the rolling statistics if NumPy is installed
+    statistics = RollingStatistics() if RollingStatistics.isAvailable() else None
+    window = qtHaGui.MainWindow(historyStore=None, scheduler=HaPollScheduler(minInterval=0, maxInterval=0, requestsPerSecond=0, jitter=0), statistics=statistics)
+    for entityId in stub.entityIds[:trackedCount]:
+        window.entityIdDict[entityId] = qtHaGui.newEntityObj(entityId, HaEntityStatus(stub.uri, "benchmark", entityId))
+    window.resize(800, 600)
+    window.show()
+
+    # Run a single refresh, waiting for the background worker to finish and the table to be redrawn
+    def refresh():
+        window.updateTableValues()
+        window.checkThreadTimer.stop()
+        while window.refreshRunning():
+            app.processEvents()
+            time.sleep(0.0005)
+        window.checkThreadTimer.stop()
+
+    results = benchmark(stub, refresh, runs)
+    renderTimes = []
+    for run in range(runs):
+        renderStart = time.perf_counter()
+        window.entityTable.viewport().repaint()
+        renderTimes.append((time.perf_counter() - renderStart) * 1000)
+    results["renderP50Ms"] = percentile(renderTimes, 0.5)
+    results["renderP99Ms"] = percentile(renderTimes, 0.99)
+    window.hide()
+    return results
+
+# Run every benchmark against a fresh stub server and return the results with details of the run
+def runBenchmarks(entityCount, payloadSize, latency, errorRate, runs, trackedCount, includeGui=True):
+    stub = HaStubProcess(entityCount, payloadSize, latency, errorRate).start()
+    apiKey = "benchmark"
+    client = HaApiClient(stub.uri, apiKey)
+    entityStatus = HaEntityStatus(stub.uri, apiKey)
+    trackedIds = stub.entityIds[:trackedCount]
+
+    # Make sure the catalog is filled before single entities are read, as readEntity checks it
+    entityStatus.readAllEntities()
+
+    results = {}
+    results["HaApiClient.returnStates"] = benchmark(stub, client.returnStates, runs)
+    results["HaApiClient.returnState"] = benchmark(stub, lambda: client.returnState(trackedIds[0]), runs)
+    results["HaEntityStatus.readAllEntities"] = benchmark(stub, entityStatus.readAllEntities, runs)
+    results["HaEntityStatus.readAllEntities (streamed)"] = benchmark(stub, lambda: entityStatus.readAllEntities(streaming=True), runs)
+    results["HaEntityStatus.readEntity"] = benchmark(stub, lambda: HaEntityStatus(stub.uri, apiKey, trackedIds[0]).readEntity(), runs)
+    results[f"HaEntityStatus.readEntities ({len(trackedIds)} entities)"] = benchmark(stub, lambda: entityStatus.readEntities(trackedIds), runs)
+    if includeGui:
+        results[f"MainWindow.updateTableValues ({len(trackedIds)} entities)"] = benchmarkMainWindow(stub, trackedCount, runs)
+
+    HaAsyncRunner.shutdown()
+    HaConnectionPool.closeAll()
+    stub.stop()
+    return {"version": gitVersion(), "time": datetime.now(timezone.utc).isoformat(), "python": platform.python_version(),
+            "settings": {"entities": entityCount, "payloadSize": payloadSize, "latency": latency, "errorRate": errorRate, "runs": runs, "tracked": trackedCount},
+            "results": results}
+
+# Return the git commit of the code being benchmarked, or None if it is not in a git repository
+def gitVersion():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Print the results as a table, with the change from earlier results if they are given
+def printResults(report, previous=None):
+    columns = [("requestsPerSecond", "req/s"), ("p50Ms", "p50 ms"), ("p99Ms", "p99 ms"), ("peakMemoryKb", "peak KB"), ("renderP50Ms", "render ms")]
+    print(f"Version {report['version']}, Python {report['python']}, settings {report['settings']}")
+    if previous != None:
+        print(f"Compared with version {previous['version']}: each value is followed by its ratio to the earlier result")
+    print(f"{'Benchmark':<52}" + "".join(f"{title:>18}" for key, title in columns))
+    for name, result in report["results"].items():
+        line = f"{name:<52}"
+        for key, title in columns:
+            value = result.get(key)
+            text = "" if value == None else f"{value:.1f}"
+            earlier = previous["results"].get(name, {}).get(key) if previous != None else None
+            if value != None and earlier:
+                text += f" ({value / earlier:.2f}x)"
+            line += f"{text:>18}"
+        print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the API client and GUI refresh against a local stub Home Assistant server.")
+    parser.add_argument("--entities", type=int, default=1000, help="number of entities held by the stub server (default 1000)")
+    parser.add_argument("--payload", type=int, default=200, help="bytes of extra attributes in each entity (default 200)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stub server waits before answering each request (default 0)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error (default 0)")
+    parser.add_argument("--runs", type=int, default=20, help="number of timed runs of each benchmark (default 20)")
+    parser.add_argument("--tracked", type=int, default=50, help="number of entities read together and shown in the main window (default 50)")
+    parser.add_argument("--no-gui", action="store_true", help="skip the main window benchmark")
+    parser.add_argument("--cache", action="store_true", help="reuse responses as the programs do, rather than timing a request to the server on every run")
+    parser.add_argument("--metrics", action="store_true", help="turn on the built-in metrics and print where the time went, which adds a little overhead")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of earlier results to compare with")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Run only the stub server, printing its address, when the benchmark starts it in a separate process
+    if args.serve:
+        stub = HaStubServer(args.entities, args.payload, args.latency, args.error_rate)
+        print(stub.uri, flush=True)
+        stub.server.serve_forever()
+    HaMetrics.enabled = args.metrics
+    if not args.cache:
+        HaConnectionPool.defaultSettings = HaConnectionSettings(stateTtl=0, statesTtl=0)
+
+    report = runBenchmarks(args.entities, args.payload, args.latency, args.error_rate, args.runs, min(args.tracked, args.entities), not args.no_gui)
+    previous = None
+    if args.compare != None:
+        with open(args.compare) as compareFile:
+            previous = json.load(compareFile)
+    printResults(report, previous)
+    if args.metrics:
+        print("Metrics over the last minute: " + HaMetrics.summaryLine())
+    if args.output != None:
+        with open(args.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+    # Exit straight away, as Qt objects left for garbage collection can otherwise outlive the application
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,61 @@
+#! /usr/bin/python3
+import sqlite3
+import threading
+import os
+
+from haApiClient import HaEntityRecord
+from haStoreConfig import openStore
+
+# Class used to keep a copy of the entity catalog of each server on disk, so the entity lists can be shown as soon as a program starts
+# Only the entity_id, friendly name and unit of each entity are kept, in a SQLite table keyed on the server address and entity_id,
+# and only the entities that were added, removed or renamed are written each time the catalog is read again
+class HaCatalogSnapshot:
+    # Class variable to store the default file name
+    defaultFile = "haCatalog.db"
+
+    #Initialise the class, creating the database if it does not exist
+    def __init__(self, path=None):
+        self.path = path if path != None else os.path.join(os.path.dirname(os.path.abspath(__file__)), HaCatalogSnapshot.defaultFile)
+        # Snapshots are loaded on the GUI thread and saved from the threads reading each server, so the connection is protected by a lock
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entities (server TEXT NOT NULL, entity_id TEXT NOT NULL, friendly_name TEXT, unit TEXT, PRIMARY KEY (server, entity_id)) WITHOUT ROWID")
+            self.connection.commit()
+
+    # Create the snapshot from the [Catalog] section of a config file, returning None if snapshots are turned off
+    # or the file cannot be opened, in which case the entity lists are only shown once each server has been read
+    @classmethod
+    def fromConfig(cls, config):
+        return openStore(cls, config, "Catalog", "catalog snapshot")
+
+    # Return the entities saved for a server as HaEntityRecords without a state, or an empty list if none have been saved
+    # The records read their full attributes through source when they are asked for, as records read from the server do
+    def load(self, uri, source=None):
+        with self.lock:
+            rows = self.connection.execute("SELECT entity_id, friendly_name, unit FROM entities WHERE server = ?", (uri.rstrip("/"),)).fetchall()
+        return [HaEntityRecord(entityId, friendly_name=friendlyName, unit=unit, source=source) for entityId, friendlyName, unit in rows]
+
+    # Save the changes to the catalog of a server, as returned by HaEntityCatalog.update
+    # If every entity in the catalog is new, the catalog was not loaded from this snapshot, so anything saved for the server before is replaced
+    def save(self, uri, catalog, changes):
+        if len(changes["added"]) == 0 and len(changes["removed"]) == 0 and len(changes["renamed"]) == 0:
+            return
+        server = uri.rstrip("/")
+        rows = []
+        for entityId in changes["added"] + changes["renamed"]:
+            record = catalog.get(entityId)
+            if record != None:
+                rows.append((server, entityId, record.friendly_name, record.unit))
+        with self.lock:
+            if len(changes["added"]) >= len(catalog):
+                self.connection.execute("DELETE FROM entities WHERE server = ?", (server,))
+            else:
+                self.connection.executemany("DELETE FROM entities WHERE server = ? AND entity_id = ?", [(server, entityId) for entityId in changes["removed"]])
+            self.connection.executemany("INSERT OR REPLACE INTO entities (server, entity_id, friendly_name, unit) VALUES (?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,205 @@
+#! /usr/bin/python3
+from array import array
+import bisect
+import sqlite3
+import threading
+import queue
+import math
+import time
+import os
+
+from haStoreConfig import openStore
+
+# Class used to keep sampled entity values on disk, so trend history survives a restart
+# Samples are stored in SQLite as append-only segments per entity, each holding packed arrays of timestamps and values,
+# so restoring hours of history for many entities reads a handful of blobs rather than one row per sample
+class HaHistoryStore:
+    # Class variables to store the default file name, how long samples are restored for, how long they are kept
+    # and how often samples older than that are removed
+    defaultFile = "haHistory.db"
+    defaultRestoreHours = 6.0
+    defaultRetentionDays = 30.0
+    pruneInterval = 3600.0
+
+    #Initialise the class, creating the database if it does not exist
+    def __init__(self, path=None, flushInterval=2.0, batchSize=500, segmentSize=1024):
+        self.path = path if path != None else os.path.join(os.path.dirname(os.path.abspath(__file__)), HaHistoryStore.defaultFile)
+        # Samples are written in batches by a background thread, either when the batch is full or after flushInterval seconds
+        self.flushInterval = flushInterval
+        self.batchSize = batchSize
+        # Number of samples in a segment before a new one is started
+        self.segmentSize = segmentSize
+        # Hours of history restored when a program starts
+        self.restoreHours = HaHistoryStore.defaultRestoreHours
+        # Days samples are kept for before they are removed, or 0 to keep them for good
+        self.retentionDays = HaHistoryStore.defaultRetentionDays
+        # Time before which prune has asked for samples to be removed, or None
+        self.pruneBefore = None
+        self.queue = queue.Queue()
+
+        # Reads happen on the calling thread through their own connection, protected by a lock
+        self.readConnection = sqlite3.connect(self.path, check_same_thread=False)
+        self.readLock = threading.Lock()
+        with self.readLock:
+            self.readConnection.execute("PRAGMA journal_mode=WAL")
+            self.readConnection.execute("CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, entity_id TEXT NOT NULL, start_time REAL NOT NULL, end_time REAL NOT NULL, timestamps BLOB NOT NULL, vals BLOB NOT NULL)")
+            self.readConnection.execute("CREATE INDEX IF NOT EXISTS segments_entity_time ON segments (entity_id, end_time)")
+            self.readConnection.execute("CREATE TABLE IF NOT EXISTS selected (position INTEGER PRIMARY KEY, entity_id TEXT NOT NULL)")
+            self.readConnection.commit()
+
+        self.thread = threading.Thread(target=self.writeSamples, daemon=True)
+        self.thread.start()
+
+    # Create the store from the [History] section of a config file, returning None if history is turned off
+    # or the file cannot be opened, for example because the folder holding it cannot be written to
+    @classmethod
+    def fromConfig(cls, config):
+        store = openStore(cls, config, "History", "history")
+        if store != None and "History" in config:
+            store.restoreHours = config["History"].getfloat("RestoreHours", store.restoreHours)
+            store.retentionDays = config["History"].getfloat("RetentionDays", store.retentionDays)
+        return store
+
+    # Queue a sample to be written. Values that are not numbers are stored as NaN
+    def addSample(self, entityId, timestamp, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = math.nan
+        self.queue.put((entityId, timestamp, value))
+
+    # Wait until every sample queued so far has been written
+    def flush(self):
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        flushed.wait()
+
+    # Write any queued samples and stop the background thread
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        with self.readLock:
+            self.readConnection.close()
+
+    # Background thread that collects queued samples and writes them in a single transaction per batch
+    # Samples older than retentionDays are removed shortly after the store is opened and then every pruneInterval seconds
+    def writeSamples(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        # The newest segment of each entity is kept in memory and rewritten as it grows, until it is full
+        openSegments = {}
+        batch = []
+        waiters = []
+        nextPrune = time.monotonic()
+        running = True
+        while running:
+            deadline = time.monotonic() + self.flushInterval
+            while len(batch) < self.batchSize:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item == None:
+                    running = False
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+            if len(batch) > 0:
+                self.writeBatch(connection, openSegments, batch)
+                batch = []
+            if self.retentionDays > 0 and time.monotonic() >= nextPrune:
+                self.removeSegments(connection, openSegments, time.time() - self.retentionDays * 86400)
+                nextPrune = time.monotonic() + HaHistoryStore.pruneInterval
+            if self.pruneBefore != None:
+                self.removeSegments(connection, openSegments, self.pruneBefore)
+                self.pruneBefore = None
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+        connection.close()
+
+    # Append a batch of samples to the open segment of each entity
+    def writeBatch(self, connection, openSegments, batch):
+        changedIds = {}
+        for entityId, timestamp, value in batch:
+            segment = openSegments.get(entityId)
+            if segment == None or len(segment[1]) >= self.segmentSize:
+                segment = [None, array("d"), array("d")]
+                openSegments[entityId] = segment
+            # Keep each segment in time order, which only needs an insert when older samples arrive late
+            if len(segment[1]) == 0 or timestamp >= segment[1][-1]:
+                segment[1].append(timestamp)
+                segment[2].append(value)
+            else:
+                position = bisect.bisect_right(segment[1], timestamp)
+                segment[1].insert(position, timestamp)
+                segment[2].insert(position, value)
+            changedIds[entityId] = True
+        for entityId in changedIds:
+            segmentId, timestamps, values = openSegments[entityId]
+            row = (entityId, timestamps[0], timestamps[-1], timestamps.tobytes(), values.tobytes())
+            if segmentId == None:
+                openSegments[entityId][0] = connection.execute("INSERT INTO segments (entity_id, start_time, end_time, timestamps, vals) VALUES (?, ?, ?, ?, ?)", row).lastrowid
+            else:
+                connection.execute("UPDATE segments SET entity_id = ?, start_time = ?, end_time = ?, timestamps = ?, vals = ? WHERE id = ?", row + (segmentId,))
+        connection.commit()
+
+    # Remove segments that only hold samples older than a given time, forgetting any of them still open so they are not written again
+    def removeSegments(self, connection, openSegments, olderThan):
+        connection.execute("DELETE FROM segments WHERE end_time < ?", (olderThan,))
+        connection.commit()
+        for entityId in [entityId for entityId, segment in openSegments.items() if segment[1][-1] < olderThan]:
+            del openSegments[entityId]
+
+    # Return the samples for each entity between two times as a dict of (timestamps, values) arrays, oldest first
+    # If limit is given, only the newest limit samples of each entity are returned
+    def readRange(self, entityIds, startTime, endTime=None, limit=None):
+        if endTime == None:
+            endTime = time.time()
+        samples = {}
+        with self.readLock:
+            for entityId in entityIds:
+                timestamps = array("d")
+                values = array("d")
+                # Segments are sorted internally, so the samples are only out of order if two segments overlap
+                overlapping = False
+                rows = self.readConnection.execute("SELECT start_time, timestamps, vals FROM segments WHERE entity_id = ? AND end_time >= ? AND start_time <= ? ORDER BY start_time, id", (entityId, startTime, endTime))
+                for segmentStart, timestampBytes, valueBytes in rows:
+                    if len(timestamps) > 0 and segmentStart < timestamps[-1]:
+                        overlapping = True
+                    timestamps.frombytes(timestampBytes)
+                    values.frombytes(valueBytes)
+                samples[entityId] = trimSamples(timestamps, values, startTime, endTime, limit, overlapping)
+        return samples
+
+    # Remove segments that only hold samples older than a given time, waiting until they have been removed
+    # The background thread removes them, as it holds the newest segment of each entity open
+    def prune(self, olderThan):
+        self.pruneBefore = olderThan
+        self.flush()
+
+    # Store the entities that are being tracked, in the order they are shown
+    def saveSelection(self, entityIds):
+        with self.readLock:
+            self.readConnection.execute("DELETE FROM selected")
+            self.readConnection.executemany("INSERT INTO selected (position, entity_id) VALUES (?, ?)", list(enumerate(entityIds)))
+            self.readConnection.commit()
+
+    # Return the entities that were being tracked last time
+    def loadSelection(self):
+        with self.readLock:
+            return [row[0] for row in self.readConnection.execute("SELECT entity_id FROM selected ORDER BY position")]
+
+# Sort samples by time if segments overlapped, then cut them down to the requested time range and number of samples
+def trimSamples(timestamps, values, startTime, endTime, limit, overlapping):
+    if overlapping:
+        order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+        timestamps = array("d", [timestamps[i] for i in order])
+        values = array("d", [values[i] for i in order])
+    first = bisect.bisect_left(timestamps, startTime)
+    last = bisect.bisect_right(timestamps, endTime)
+    if limit != None:
+        first = max(first, last - limit)
+    return timestamps[first:last], values[first:last]
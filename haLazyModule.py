@@ -0,0 +1,26 @@
+#! /usr/bin/python3
+import importlib
+import importlib.util
+
+# Class used to stand in for a module that is only imported the first time one of its attributes is used
+# Libraries that are optional or take a noticeable time to import, such as aiohttp, websocket-client and NumPy, are held this way,
+# so the programs start quickly and can check whether an optional library is installed without importing it
+class LazyModule:
+    #Initialise the class with the name of the module
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    # Import the module if it has not been imported yet and return it
+    def load(self):
+        if self.module == None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    # Return True if the module is installed, without importing it
+    def isAvailable(self):
+        return self.module != None or importlib.util.find_spec(self.name) != None
+
+    # Attributes that are not part of this class are read from the module, importing it the first time
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
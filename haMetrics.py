@@ -0,0 +1,242 @@
+#! /usr/bin/python3
+import bisect
+import threading
+import time
+import sys
+
+# Class used to count how long something takes over the last minute or so, in buckets that grow by a quarter each time from 0.1 ms to several minutes
+# The window is split into slices, and the oldest slice is cleared as time moves on, so old timings drop out without storing each one.
+# Totals since the program started are kept as well, for Prometheus
+class RollingHistogram:
+    # Class variable to store the upper bound of each bucket in seconds. Anything longer goes in one last bucket
+    bounds = [0.0001 * 1.25 ** index for index in range(70)]
+
+    #Initialise the class
+    def __init__(self, windowSeconds=60, sliceCount=6):
+        self.sliceSeconds = windowSeconds / sliceCount
+        self.slices = [[0] * (len(RollingHistogram.bounds) + 1) for index in range(sliceCount)]
+        self.sliceNumber = int(time.monotonic() // self.sliceSeconds)
+        self.totalCounts = [0] * (len(RollingHistogram.bounds) + 1)
+        self.totalCount = 0
+        self.totalSeconds = 0.0
+        self.lock = threading.Lock()
+
+    # Clear the slices that have fallen out of the window since the last timing
+    def rotate(self, now):
+        sliceNumber = int(now // self.sliceSeconds)
+        for number in range(max(self.sliceNumber + 1, sliceNumber - len(self.slices) + 1), sliceNumber + 1):
+            counts = self.slices[number % len(self.slices)]
+            for index in range(len(counts)):
+                counts[index] = 0
+        self.sliceNumber = max(self.sliceNumber, sliceNumber)
+
+    # Add a timing in seconds
+    def record(self, seconds):
+        index = bisect.bisect_left(RollingHistogram.bounds, seconds)
+        with self.lock:
+            self.rotate(time.monotonic())
+            self.slices[self.sliceNumber % len(self.slices)][index] += 1
+            self.totalCounts[index] += 1
+            self.totalCount += 1
+            self.totalSeconds += seconds
+
+    # Return the number of timings in each bucket over the window
+    def windowCounts(self):
+        with self.lock:
+            self.rotate(time.monotonic())
+            return [sum(counts) for counts in zip(*self.slices)]
+
+    # Return the number of timings over the window and the upper bound of the bucket holding each of the given fractions, such as 0.5 for the median
+    def percentiles(self, fractions):
+        counts = self.windowCounts()
+        count = sum(counts)
+        results = []
+        for fraction in fractions:
+            if count == 0:
+                results.append(None)
+                continue
+            target = fraction * count
+            seen = 0
+            for index in range(len(counts)):
+                seen += counts[index]
+                if seen >= target and counts[index] > 0:
+                    break
+            results.append(RollingHistogram.bounds[min(index, len(RollingHistogram.bounds) - 1)])
+        return count, results
+
+# Context manager used to time a block of code while metrics are turned on
+class MetricTimer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.histogram.record(time.perf_counter() - self.start)
+
+# Class used to add up the time spent in several separate pieces of code, such as parsing each chunk of a response, and record it once
+class MetricStopwatch:
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.elapsed = 0.0
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.elapsed += time.perf_counter() - self.started
+
+    def record(self):
+        self.histogram.record(self.elapsed)
+
+# Timer and stopwatch used while metrics are turned off, which do nothing so the code being timed runs at full speed
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def record(self):
+        pass
+
+# Class used to collect timings of the busiest parts of the programs and report them in the status bar, a log line or a Prometheus endpoint
+# Metrics are turned off unless the [Metrics] section of the config file turns them on, and then cost no more than a call that returns NullTimer
+class HaMetrics:
+    # Class variables to store whether metrics are collected, the histogram of each metric and the background reporting
+    enabled = False
+    histograms = {}
+    histogramsLock = threading.Lock()
+    nullTimer = NullTimer()
+    server = None
+    logThread = None
+
+    # Turn metrics on or off and start the Prometheus endpoint and log line from the [Metrics] section of a config file
+    @classmethod
+    def configure(cls, config):
+        if "Metrics" not in config:
+            return
+        section = config["Metrics"]
+        cls.enabled = section.getboolean("Enabled", cls.enabled)
+        if cls.enabled:
+            if section.getint("PrometheusPort", 0) > 0:
+                cls.startServer(section.getint("PrometheusPort"), section.get("PrometheusAddress", "127.0.0.1"))
+            if section.getfloat("LogInterval", 0) > 0:
+                cls.startLogging(section.getfloat("LogInterval"))
+
+    # Return the histogram for a metric, creating it the first time it is used
+    @classmethod
+    def histogram(cls, name):
+        histogram = cls.histograms.get(name)
+        if histogram == None:
+            with cls.histogramsLock:
+                histogram = cls.histograms.setdefault(name, RollingHistogram())
+        return histogram
+
+    # Return a context manager that records how long its block takes
+    @classmethod
+    def timer(cls, name):
+        if not cls.enabled:
+            return cls.nullTimer
+        return MetricTimer(cls.histogram(name))
+
+    # Return a stopwatch that adds up time between start and stop calls, recording the total when record is called
+    @classmethod
+    def stopwatch(cls, name):
+        if not cls.enabled:
+            return cls.nullTimer
+        return MetricStopwatch(cls.histogram(name))
+
+    # Record a timing in seconds that was measured elsewhere
+    @classmethod
+    def record(cls, name, seconds):
+        if cls.enabled:
+            cls.histogram(name).record(seconds)
+
+    # Return a short summary of the median and 99th percentile of each metric over the last minute, such as "fetch 12/40 ms"
+    # Each metric is labelled with the last part of its name
+    @classmethod
+    def summaryLine(cls, names=None):
+        parts = []
+        for name in (names if names != None else sorted(cls.histograms)):
+            if name in cls.histograms:
+                count, (median, p99) = cls.histograms[name].percentiles([0.5, 0.99])
+                if count > 0:
+                    parts.append(f"{name.rsplit('.', 1)[-1]} {formatMilliseconds(median)}/{formatMilliseconds(p99)}")
+        if len(parts) == 0:
+            return ""
+        return "  ".join(parts) + " ms (p50/p99)"
+
+    # Return every metric as a Prometheus histogram in the text exposition format, counting every timing since the program started
+    @classmethod
+    def prometheusText(cls):
+        lines = []
+        for name in sorted(cls.histograms):
+            histogram = cls.histograms[name]
+            metricName = "ha_" + name.replace(".", "_") + "_seconds"
+            with histogram.lock:
+                totalCounts = list(histogram.totalCounts)
+                totalCount = histogram.totalCount
+                totalSeconds = histogram.totalSeconds
+            lines.append(f"# TYPE {metricName} histogram")
+            # Every bucket is always written, even when it is empty, so no bucket series first appears with a count that rate() would miss
+            cumulative = 0
+            for index in range(len(RollingHistogram.bounds)):
+                cumulative += totalCounts[index]
+                lines.append(f'{metricName}_bucket{{le="{RollingHistogram.bounds[index]:.6g}"}} {cumulative}')
+            lines.append(f'{metricName}_bucket{{le="+Inf"}} {totalCount}')
+            lines.append(f"{metricName}_sum {totalSeconds}")
+            lines.append(f"{metricName}_count {totalCount}")
+        return "\n".join(lines) + "\n"
+
+    # Serve the metrics at http://address:port/metrics from a background thread
+    @classmethod
+    def startServer(cls, port, address="127.0.0.1"):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = cls.prometheusText().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        cls.server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    # Write the summary line to standard error every interval seconds from a background thread
+    @classmethod
+    def startLogging(cls, interval):
+        def writeSummary():
+            while True:
+                time.sleep(interval)
+                line = cls.summaryLine()
+                if line != "":
+                    sys.stderr.write(time.strftime("%H:%M:%S ") + line + "\n")
+        cls.logThread = threading.Thread(target=writeSummary, daemon=True)
+        cls.logThread.start()
+
+# Return a time in seconds as milliseconds, with fewer decimal places as it gets longer
+def formatMilliseconds(seconds):
+    milliseconds = seconds * 1000
+    if milliseconds < 10:
+        return f"{milliseconds:.1f}"
+    return f"{milliseconds:.0f}"
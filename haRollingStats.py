@@ -0,0 +1,160 @@
+#! /usr/bin/python3
+import math
+import time
+
+from haLazyModule import LazyModule
+
+# NumPy is optional. Without it the statistics columns are simply not shown
+numpy = LazyModule("numpy")
+
+# Class used to work out rolling statistics of the recent values of many entities at once
+# The samples within the window of each entity are held in one row of a pair of NumPy arrays, used as a ring buffer per row.
+# Each sample is written into its row as it arrives, and the statistics of every row are worked out together by update,
+# so the cost depends on the size of the window rather than the length of the trend history
+class RollingStatistics:
+    # Class variables to store the default window in seconds and the number of samples kept in each row
+    defaultWindow = 300.0
+    defaultCapacity = 256
+    # Names of the statistics, in the order they are returned by get
+    names = ["min", "max", "mean", "stddev", "ratePerMinute"]
+
+    #Initialise the class. The arrays are created when the first sample is added, so NumPy is not imported until it is needed
+    def __init__(self, window=None, capacity=None):
+        self.window = window if window != None else RollingStatistics.defaultWindow
+        self.capacity = capacity if capacity != None else RollingStatistics.defaultCapacity
+        # Dict of entity_id to its row, rows that have been freed and can be used again, and the number of rows in the arrays
+        self.rows = {}
+        self.freeRows = []
+        self.rowCount = 0
+        # Timestamps and values of the samples, NaN where there is no sample, and the slot in each row written next
+        self.timestamps = None
+        self.values = None
+        self.nextSlot = None
+        # Statistics of each row from the last update, NaN where there are none
+        self.results = None
+
+    # Create the statistics from the [Statistics] section of a config file, returning None if they are turned off or NumPy is not installed
+    @classmethod
+    def fromConfig(cls, config):
+        if not cls.isAvailable():
+            return None
+        if "Statistics" not in config:
+            return cls()
+        section = config["Statistics"]
+        if not section.getboolean("Enabled", True):
+            return None
+        return cls(section.getfloat("WindowMinutes", cls.defaultWindow / 60) * 60, section.getint("Samples", cls.defaultCapacity))
+
+    # Return True if NumPy is installed, so the statistics can be worked out
+    @classmethod
+    def isAvailable(cls):
+        return numpy.isAvailable()
+
+    def __contains__(self, entityId):
+        return entityId in self.rows
+
+    # Add rows to the arrays, creating them with 8 rows the first time and doubling them after that
+    def addRows(self):
+        extraRows = max(8, self.rowCount)
+        timestamps = numpy.full((extraRows, self.capacity), numpy.nan)
+        values = numpy.full((extraRows, self.capacity), numpy.nan)
+        nextSlot = numpy.zeros(extraRows, dtype=numpy.int64)
+        results = numpy.full((extraRows, len(RollingStatistics.names)), numpy.nan)
+        if self.rowCount == 0:
+            self.timestamps, self.values, self.nextSlot, self.results = timestamps, values, nextSlot, results
+        else:
+            self.timestamps = numpy.vstack([self.timestamps, timestamps])
+            self.values = numpy.vstack([self.values, values])
+            self.nextSlot = numpy.concatenate([self.nextSlot, nextSlot])
+            self.results = numpy.vstack([self.results, results])
+        self.rowCount += extraRows
+
+    # Return the row of an entity, giving it a new row the first time it is seen and doubling the arrays when they are full
+    def rowFor(self, entityId):
+        row = self.rows.get(entityId)
+        if row != None:
+            return row
+        if len(self.freeRows) > 0:
+            row = self.freeRows.pop()
+        else:
+            row = len(self.rows)
+            if row >= self.rowCount:
+                self.addRows()
+        self.rows[entityId] = row
+        return row
+
+    # Forget the samples of an entity
+    def remove(self, entityId):
+        row = self.rows.pop(entityId, None)
+        if row != None:
+            self.timestamps[row] = numpy.nan
+            self.values[row] = numpy.nan
+            self.nextSlot[row] = 0
+            self.results[row] = numpy.nan
+            self.freeRows.append(row)
+
+    # Forget every entity that is not in a list of entity_ids
+    def retain(self, entityIds):
+        entityIds = set(entityIds)
+        for entityId in [entityId for entityId in self.rows if entityId not in entityIds]:
+            self.remove(entityId)
+
+    # Add a sample. Values that are not numbers are stored as NaN and left out of the statistics
+    def add(self, entityId, timestamp, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = math.nan
+        row = self.rowFor(entityId)
+        slot = self.nextSlot[row]
+        self.timestamps[row, slot] = timestamp
+        self.values[row, slot] = value
+        self.nextSlot[row] = (slot + 1) % self.capacity
+
+    # Replace the samples of an entity with the newest of a list of samples in time order, for example from a TrendBuffer after history is read
+    def load(self, entityId, timestamps, values):
+        self.remove(entityId)
+        first = max(0, len(timestamps) - self.capacity)
+        for index in range(first, len(timestamps)):
+            self.add(entityId, timestamps[index], values[index])
+
+    # Work out the statistics of every entity over the window ending now, returning the entity_ids whose statistics changed
+    # The newest sample of each entity is always used, as its value still holds if it has not changed within the window
+    def update(self, now=None):
+        if self.rowCount == 0:
+            return []
+        now = time.time() if now == None else now
+        timestamps = self.timestamps
+        values = self.values
+        rows = numpy.arange(len(values))
+        newest = (self.nextSlot - 1) % self.capacity
+        valid = ~numpy.isnan(values)
+        used = valid & (timestamps >= now - self.window)
+        used[rows, newest] |= valid[rows, newest]
+        count = used.sum(axis=1)
+
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            mean = numpy.where(used, values, 0.0).sum(axis=1) / count
+            minimum = numpy.where(used, values, numpy.inf).min(axis=1)
+            maximum = numpy.where(used, values, -numpy.inf).max(axis=1)
+            deviation = numpy.where(used, values - mean[:, None], 0.0)
+            stddev = numpy.sqrt((deviation ** 2).sum(axis=1) / count)
+            # The rate of change is the slope of the least squares line through the samples, in units per minute
+            times = numpy.where(used, timestamps - now, 0.0)
+            timeDeviation = numpy.where(used, times - (times.sum(axis=1) / count)[:, None], 0.0)
+            slope = (timeDeviation * deviation).sum(axis=1) / (timeDeviation ** 2).sum(axis=1)
+        ratePerMinute = numpy.where(numpy.isfinite(slope), slope * 60, 0.0)
+
+        results = numpy.column_stack([minimum, maximum, mean, stddev, ratePerMinute])
+        results[count == 0] = numpy.nan
+        changed = ~((results == self.results) | (numpy.isnan(results) & numpy.isnan(self.results))).all(axis=1)
+        self.results = results
+        changedRows = set(numpy.flatnonzero(changed).tolist())
+        return [entityId for entityId, row in self.rows.items() if row in changedRows]
+
+    # Return the statistics of an entity from the last update in the order of names, or None if it has none
+    def get(self, entityId):
+        row = self.rows.get(entityId)
+        if row == None or math.isnan(self.results[row, 0]):
+            return None
+        return self.results[row].tolist()
@@ -0,0 +1,145 @@
+#! /usr/bin/python3
+import heapq
+import random
+import time
+
+# Class used to decide when each tracked entity is next polled, so entities that change often are read often and stable ones rarely
+# Each entity has its own interval, which shrinks when its value changes, grows while it stays the same and backs off with jitter after errors.
+# Polls are limited by a requests-per-second budget shared by every entity
+class HaPollScheduler:
+    # Class variables to store the default shortest and longest interval in seconds, and the request budget (0 for no limit)
+    defaultMinInterval = 2.0
+    defaultMaxInterval = 300.0
+    defaultRequestsPerSecond = 5.0
+
+    #Initialise the class
+    def __init__(self, minInterval=None, maxInterval=None, requestsPerSecond=None, speedUp=0.5, slowDown=1.5, jitter=0.1):
+        self.minInterval = minInterval if minInterval != None else HaPollScheduler.defaultMinInterval
+        self.maxInterval = maxInterval if maxInterval != None else HaPollScheduler.defaultMaxInterval
+        self.requestsPerSecond = requestsPerSecond if requestsPerSecond != None else HaPollScheduler.defaultRequestsPerSecond
+        # How much the interval is multiplied by when a value changes or stays the same, and how far each poll time is randomly moved
+        self.speedUp = speedUp
+        self.slowDown = slowDown
+        self.jitter = jitter
+        # Dict of entity_id to [interval, next poll time or None while it is being read, errors in a row]
+        self.entities = {}
+        # Heap of (next poll time, entity_id). Entries that no longer match self.entities are skipped when they reach the top
+        self.heap = []
+        # Requests that can be sent straight away, refilled at requestsPerSecond up to one second's worth
+        self.tokens = max(1.0, self.requestsPerSecond)
+        self.lastRefill = time.monotonic()
+
+    # Create the scheduler from the [Polling] section of a config file, falling back to the defaults for anything missing
+    @classmethod
+    def fromConfig(cls, config):
+        if "Polling" not in config:
+            return cls()
+        section = config["Polling"]
+        return cls(section.getfloat("MinInterval", None), section.getfloat("MaxInterval", None), section.getfloat("RequestsPerSecond", None))
+
+    # Return a new scheduler with the same settings and no entities, for example so each server has its own request budget
+    def copy(self):
+        return HaPollScheduler(self.minInterval, self.maxInterval, self.requestsPerSecond, self.speedUp, self.slowDown, self.jitter)
+
+    def __len__(self):
+        return len(self.entities)
+
+    # Start scheduling an entity, polling it straight away
+    def add(self, entityId, now=None):
+        if entityId not in self.entities:
+            self.entities[entityId] = [self.minInterval, None, 0]
+            self.schedule(entityId, time.monotonic() if now == None else now)
+
+    # Stop scheduling an entity
+    def remove(self, entityId):
+        self.entities.pop(entityId, None)
+
+    # Schedule exactly the given entities, adding new ones and removing any others
+    def setEntities(self, entityIds, now=None):
+        entityIds = set(entityIds)
+        for entityId in [entityId for entityId in self.entities if entityId not in entityIds]:
+            self.remove(entityId)
+        for entityId in entityIds:
+            self.add(entityId, now)
+
+    # Make every entity due straight away, for example to catch up after pushed updates stop
+    def pollNow(self, now=None):
+        now = time.monotonic() if now == None else now
+        for entityId in self.entities:
+            if self.entities[entityId][1] != None:
+                self.schedule(entityId, now)
+
+    # Set the time an entity is next polled
+    def schedule(self, entityId, nextTime):
+        self.entities[entityId][1] = nextTime
+        heapq.heappush(self.heap, (nextTime, entityId))
+
+    # Add the requests earned since the last refill to the budget
+    def refill(self, now):
+        self.tokens = min(max(1.0, self.requestsPerSecond), self.tokens + max(0, now - self.lastRefill) * self.requestsPerSecond)
+        self.lastRefill = now
+
+    # Return the entities that are due, oldest first, as far as the budget allows. They are not scheduled again until recordResult is called
+    # If bulkRead is given it is called with a number of entities and returns True if they are read with a single request.
+    # If include is given, only the due entities in it are taken and any others stay due
+    def takeDue(self, now=None, bulkRead=None, include=None):
+        now = time.monotonic() if now == None else now
+        self.refill(now)
+        due = []
+        excluded = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            nextTime, entityId = heapq.heappop(self.heap)
+            if entityId in self.entities and self.entities[entityId][1] == nextTime:
+                if include == None or entityId in include:
+                    due.append(entityId)
+                else:
+                    excluded.append((nextTime, entityId))
+        for entry in excluded:
+            heapq.heappush(self.heap, entry)
+
+        # Everything due is read at the cost of one request when a bulk read is used, otherwise each entity costs one request
+        if self.requestsPerSecond <= 0:
+            taken = due
+        elif len(due) > 0 and bulkRead != None and bulkRead(len(due)) and self.tokens >= 1:
+            taken = due
+            self.tokens -= 1
+        else:
+            taken = due[:max(0, int(self.tokens))]
+            self.tokens -= len(taken)
+        # Entities left out by the budget stay due and are taken first next time
+        for entityId in due[len(taken):]:
+            heapq.heappush(self.heap, (self.entities[entityId][1], entityId))
+        for entityId in taken:
+            self.entities[entityId][1] = None
+        return taken
+
+    # Schedule the next poll of an entity after it has been read, speeding up if it changed, slowing down if not and backing off after an error
+    def recordResult(self, entityId, changed, error=False, now=None):
+        if entityId not in self.entities:
+            return
+        now = time.monotonic() if now == None else now
+        state = self.entities[entityId]
+        if error:
+            # Wait twice as long after each error in a row, spread over the second half of the wait so clients do not retry together
+            state[2] += 1
+            delay = min(self.maxInterval, state[0] * 2 ** state[2])
+            self.schedule(entityId, now + random.uniform(delay / 2, delay))
+            return
+        state[2] = 0
+        if changed:
+            state[0] = max(self.minInterval, state[0] * self.speedUp)
+        else:
+            state[0] = min(self.maxInterval, state[0] * self.slowDown)
+        self.schedule(entityId, now + state[0] * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    # Return the number of seconds until another entity can be polled, or None if nothing is scheduled
+    def nextDueIn(self, now=None):
+        now = time.monotonic() if now == None else now
+        while len(self.heap) > 0 and (self.heap[0][1] not in self.entities or self.entities[self.heap[0][1]][1] != self.heap[0][0]):
+            heapq.heappop(self.heap)
+        if len(self.heap) == 0:
+            return None
+        self.refill(now)
+        # If the budget is used up, wait until the next request has been earned
+        budgetWait = 0 if self.tokens >= 1 or self.requestsPerSecond <= 0 else (1 - self.tokens) / self.requestsPerSecond
+        return max(0, self.heap[0][0] - now, budgetWait)
@@ -0,0 +1,20 @@
+#! /usr/bin/python3
+import sqlite3
+import os
+
+# Create a store kept in a SQLite file, such as HaHistoryStore or HaCatalogSnapshot, from its section of a config file
+# The section can change the file used (Path) or turn the store off (Enabled = no). Relative paths are taken from the folder holding the programs,
+# like the config file itself. None is returned if the store is turned off or its file cannot be opened, for example because the folder
+# holding it cannot be written to, so the programs carry on without it
+def openStore(cls, config, sectionName, description):
+    section = config[sectionName] if sectionName in config else None
+    if section != None and not section.getboolean("Enabled", True):
+        return None
+    path = section.get("Path", None) if section != None else None
+    if path != None and not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    try:
+        return cls(path=path)
+    except sqlite3.Error as error:
+        print(f"Could not open the {description} file {path if path != None else cls.defaultFile} ({error}), so it will not be used. Set Path in the [{sectionName}] section of the config file to a folder that can be written to")
+        return None
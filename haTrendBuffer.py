@@ -0,0 +1,148 @@
+#! /usr/bin/python3
+from array import array
+import math
+import time
+
+# Class used to store the trend history of an entity in a fixed amount of memory, dropping the oldest samples when it is full
+class TrendBuffer:
+    # Class variables to store the default number of samples kept and how long they are kept for (0 keeps them until the buffer is full)
+    defaultCapacity = 2000
+    defaultRetention = 0
+
+    #Initialise the class
+    def __init__(self, capacity=None, retention=None):
+        self.capacity = capacity if capacity != None else TrendBuffer.defaultCapacity
+        self.retention = retention if retention != None else TrendBuffer.defaultRetention
+        # Timestamps and values are stored in preallocated arrays of doubles used as a ring buffer
+        self.timestampArray = array("d", bytes(8 * self.capacity))
+        self.valueArray = array("d", bytes(8 * self.capacity))
+        self.start = 0
+        self.count = 0
+        # Count every sample ever appended, so cached downsampled results know when they are out of date
+        self.appendCount = 0
+        self.downsampleCache = None
+
+    # Create an empty buffer from the [Trend] section of a config file, falling back to the defaults for anything missing
+    @classmethod
+    def fromConfig(cls, config):
+        if "Trend" not in config:
+            return cls()
+        section = config["Trend"]
+        return cls(section.getint("Capacity", cls.defaultCapacity), section.getfloat("RetentionHours", cls.defaultRetention / 3600) * 3600)
+
+    # Return a new, empty buffer with the same capacity and retention, for example one for each entity
+    def copy(self):
+        return TrendBuffer(self.capacity, self.retention)
+
+    def __len__(self):
+        return self.count
+
+    # Add a sample. Values that are not numbers are stored as NaN so they show as gaps
+    def append(self, value, timestamp=None):
+        if timestamp == None:
+            timestamp = time.time()
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = math.nan
+        end = (self.start + self.count) % self.capacity
+        self.timestampArray[end] = timestamp
+        self.valueArray[end] = value
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+        self.appendCount += 1
+        self.expire(timestamp)
+
+    # Add many samples at once, for example when history is restored, keeping only as many as fit in the buffer
+    def extend(self, timestamps, values):
+        first = max(0, len(timestamps) - self.capacity)
+        for index in range(first, len(timestamps)):
+            self.append(values[index], timestamps[index])
+
+    # Merge samples that may be older than those already held, such as history read from the server, keeping them in time order
+    def merge(self, timestamps, values):
+        samples = dict(zip(self.timestamps(), self.values()))
+        for index in range(len(timestamps)):
+            if timestamps[index] not in samples:
+                samples[timestamps[index]] = values[index]
+        ordered = sorted(samples)
+        self.start = 0
+        self.count = 0
+        self.extend(ordered, [samples[timestamp] for timestamp in ordered])
+
+    # Drop samples older than the retention period
+    def expire(self, now=None):
+        if self.retention <= 0:
+            return
+        if now == None:
+            now = time.time()
+        oldest = now - self.retention
+        while self.count > 0 and self.timestampArray[self.start] < oldest:
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+
+    # Return the samples of one of the arrays in order, oldest first
+    def ordered(self, source):
+        end = self.start + self.count
+        if end <= self.capacity:
+            return source[self.start:end]
+        return source[self.start:] + source[:end - self.capacity]
+
+    # Return the timestamps, oldest first
+    def timestamps(self):
+        return self.ordered(self.timestampArray)
+
+    # Return the values, oldest first
+    def values(self):
+        return self.ordered(self.valueArray)
+
+    # Return the newest value, or None if the buffer is empty
+    def latest(self):
+        if self.count == 0:
+            return None
+        return self.valueArray[(self.start + self.count - 1) % self.capacity]
+
+    # Return at most threshold samples that keep the shape of the line, using the Largest-Triangle-Three-Buckets algorithm
+    def downsample(self, threshold):
+        if self.downsampleCache != None and self.downsampleCache[0] == (self.appendCount, self.start, self.count, threshold):
+            return self.downsampleCache[1]
+        # Samples that are not numbers cannot be placed on the line, so they are left out
+        timestamps = self.timestamps()
+        values = self.values()
+        points = [(timestamps[i], values[i]) for i in range(len(values)) if not math.isnan(values[i])]
+        result = lttb(points, threshold)
+        self.downsampleCache = ((self.appendCount, self.start, self.count, threshold), result)
+        return result
+
+# Reduce a list of (x, y) points to at most threshold points, keeping the first and last points and the shape of the line in between
+def lttb(points, threshold):
+    pointCount = len(points)
+    if threshold >= pointCount or threshold < 3:
+        return points
+
+    sampled = [points[0]]
+    bucketSize = (pointCount - 2) / (threshold - 2)
+    previous = points[0]
+    for bucket in range(threshold - 2):
+        # The point chosen from this bucket makes the largest triangle with the previous chosen point and the average of the next bucket
+        bucketStart = int(bucket * bucketSize) + 1
+        bucketEnd = int((bucket + 1) * bucketSize) + 1
+        nextStart = bucketEnd
+        nextEnd = min(int((bucket + 2) * bucketSize) + 1, pointCount)
+        nextCount = nextEnd - nextStart
+        averageX = sum(point[0] for point in points[nextStart:nextEnd]) / nextCount
+        averageY = sum(point[1] for point in points[nextStart:nextEnd]) / nextCount
+
+        largestArea = -1
+        chosen = points[bucketStart]
+        for point in points[bucketStart:bucketEnd]:
+            area = abs((previous[0] - averageX) * (point[1] - previous[1]) - (previous[0] - point[0]) * (averageY - previous[1]))
+            if area > largestArea:
+                largestArea = area
+                chosen = point
+        sampled.append(chosen)
+        previous = chosen
+    sampled.append(points[-1])
+    return sampled
@@ -0,0 +1,138 @@
+#! /usr/bin/python3
+import json
+import threading
+
+from haLazyModule import LazyModule
+
+# The websocket-client library is optional. Without it, callers simply keep polling the REST API
+websocket = LazyModule("websocket")
+
+# Class used to receive state changes pushed from the Home Assistant WebSocket API
+class HaWebSocketClient:
+    #Initialise the class
+    def __init__(self, uri, apiKey, onStateChanged=None, onConnectionChanged=None, reconnectDelay=5, receiveTimeout=1):
+        self.uri = uri
+        self.apiKey = apiKey
+        # Functions called with (entity_id, new_state) for every change and with True or False when the connection opens or drops
+        self.onStateChanged = onStateChanged
+        self.onConnectionChanged = onConnectionChanged
+        # Seconds to wait before reconnecting and seconds to wait for each message before checking whether to stop
+        self.reconnectDelay = reconnectDelay
+        self.receiveTimeout = receiveTimeout
+        # Variables to track the connection and the background thread
+        self.connected = False
+        self.messageId = 0
+        self.socket = None
+        self.thread = None
+        self.stopEvent = threading.Event()
+
+    # Function to turn the REST address of the server into the address of its WebSocket API
+    def websocketUri(self):
+        uri = self.uri.rstrip("/")
+        if uri.startswith("https://"):
+            uri = "wss://" + uri[len("https://"):]
+        elif uri.startswith("http://"):
+            uri = "ws://" + uri[len("http://"):]
+        return uri + "/api/websocket"
+
+    # Function to report whether pushed updates can be used at all
+    def isAvailable(self):
+        return websocket.isAvailable()
+
+    # Start listening for changes in a background thread
+    def start(self):
+        if not self.isAvailable():
+            print("The websocket-client library is not installed. Polling will be used instead")
+            self.setConnected(False)
+            return
+        if self.thread != None and self.thread.is_alive():
+            return
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Stop listening and close the socket
+    def stop(self):
+        self.stopEvent.set()
+        if self.socket != None:
+            try:
+                self.socket.close()
+            except Exception:
+                pass
+        if self.thread != None and self.thread != threading.current_thread():
+            self.thread.join(timeout=self.receiveTimeout + 1)
+
+    # Update the connection flag and tell the caller if it changed
+    def setConnected(self, connected):
+        changed = connected != self.connected
+        self.connected = connected
+        if changed and self.onConnectionChanged != None:
+            self.onConnectionChanged(connected)
+
+    # Send a message with the next message id, which Home Assistant requires to increase each time
+    def sendCommand(self, message):
+        self.messageId += 1
+        message["id"] = self.messageId
+        self.socket.send(json.dumps(message))
+        return self.messageId
+
+    # Wait for the next message from the server
+    def receiveMessage(self):
+        while not self.stopEvent.is_set():
+            try:
+                message = self.socket.recv()
+            except websocket.WebSocketTimeoutException:
+                continue
+            if not message:
+                raise ConnectionError("The server closed the connection")
+            return json.loads(message)
+        return None
+
+    # Connect, authenticate with the API key and subscribe to state changes
+    def connect(self):
+        self.messageId = 0
+        self.socket = websocket.create_connection(self.websocketUri(), timeout=self.reconnectDelay)
+        self.socket.settimeout(self.receiveTimeout)
+
+        message = self.receiveMessage()
+        if message == None or message.get("type") != "auth_required":
+            raise ConnectionError("Unexpected greeting from the WebSocket API")
+        self.socket.send(json.dumps({"type": "auth", "access_token": self.apiKey}))
+        message = self.receiveMessage()
+        if message == None or message.get("type") != "auth_ok":
+            raise ConnectionError("The WebSocket API did not accept the API key")
+
+        subscriptionId = self.sendCommand({"type": "subscribe_events", "event_type": "state_changed"})
+        message = self.receiveMessage()
+        if message == None or message.get("id") != subscriptionId or not message.get("success"):
+            raise ConnectionError("Could not subscribe to state changes")
+
+    # Pass every state change on to the caller until the socket drops or the client is stopped
+    def listen(self):
+        while not self.stopEvent.is_set():
+            message = self.receiveMessage()
+            if message == None:
+                break
+            if message.get("type") == "event":
+                data = message["event"]["data"]
+                if self.onStateChanged != None:
+                    self.onStateChanged(data["entity_id"], data.get("new_state"))
+
+    # Keep the connection open, reconnecting after a delay whenever it drops
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                self.connect()
+                self.setConnected(True)
+                self.listen()
+            except Exception as error:
+                if not self.stopEvent.is_set():
+                    print(f"WebSocket connection lost: {error}")
+            finally:
+                if self.socket != None:
+                    try:
+                        self.socket.close()
+                    except Exception:
+                        pass
+                self.setConnected(False)
+            self.stopEvent.wait(self.reconnectDelay)
@@ -1,29 +1,55 @@
 import sys
-import requests
-from PyQt6.QtWidgets import QApplication, QMainWindow, QPushButton, QHBoxLayout, QVBoxLayout, QWidget, QLabel, QLineEdit, QTableWidget, QMenu, QTableWidgetItem, QHeaderView, QMessageBox
-from PyQt6.QtGui import QFont
-from PyQt6.QtCore import QTimer
-from haApiClient import HaEntityStatus
-from rich import print
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
-from matplotlib.figure import Figure
-import matplotlib.pyplot as plot
 import os
+import time
+
+# Record how long each part of starting up takes, if asked to with --timing or the HA_GUI_TIMING environment variable
+class StartupTimer:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lastTime = time.perf_counter()
+        self.phases = []
+
+    # Record the time taken since the previous phase
+    def mark(self, phase):
+        if self.enabled:
+            now = time.perf_counter()
+            self.phases.append((phase, now - self.lastTime))
+            self.lastTime = now
+
+    # Print the time taken by each phase and in total
+    def report(self):
+        if self.enabled:
+            for phase, duration in self.phases:
+                print(f"{phase:<28}{duration * 1000:8.1f} ms")
+            print(f"{'Total':<28}{sum(duration for phase, duration in self.phases) * 1000:8.1f} ms")
+
+startupTimer = StartupTimer("--timing" in sys.argv or os.environ.get("HA_GUI_TIMING", "") not in ("", "0"))
+
+from PyQt6.QtWidgets import QApplication, QMainWindow, QPushButton, QHBoxLayout, QVBoxLayout, QWidget, QLabel, QLineEdit, QTableView, QMenu, QHeaderView, QStyledItemDelegate
+from PyQt6.QtGui import QFont, QPainter, QPen, QColor, QPolygonF
+from PyQt6.QtCore import Qt, QTimer, QObject, QRunnable, QThreadPool, QPointF, QAbstractTableModel, QModelIndex, QItemSelection, QItemSelectionModel, pyqtSignal
+startupTimer.mark("Import Qt")
+from haApiClient import HaServerGroup, HaEntityStatus, HaAsyncRunner, applyClientSettings, entityTimestamp, qualifyEntityId, splitEntityId, print
+from haWebSocketClient import HaWebSocketClient
+from haTrendBuffer import TrendBuffer
+from haHistoryStore import HaHistoryStore
+from haCatalogSnapshot import HaCatalogSnapshot
+from haScheduler import HaPollScheduler
+from haMetrics import HaMetrics
+from haRollingStats import RollingStatistics
 import configparser
+import json
+from array import array
+import math
+startupTimer.mark("Import client modules")
 
 # Create a font object that we will use for all widgets
 defaultFont = QFont('Arial', 14)
 
-#Create some custom classes that set default font details accordingly
+# List of entity types that can be plotted
+domainPlotTypes = ["input_number", "input_text", "number", "sensor"]
 
-# Message box custom class
-class CustomQMessageBox(QMessageBox):
-    def __init__(self, title, text, font=defaultFont):
-        super().__init__()
-        self.setFont(font)
-        self.setWindowTitle(title)
-        self.setText(text)
-        self.exec()
+#Create some custom classes that set default font details accordingly
 
 # Text box custom class
 class CustomQLineEdit(QLineEdit):
@@ -43,11 +69,14 @@ class CustomQPushButton(QPushButton):
         super().__init__(text)
         self.setFont(font)
 
-# Table widget custom class
-class CustomQTableWidget(QTableWidget):
-    def __init__(self, font = defaultFont):
+# Table view custom class. Rows are drawn from a model as they scroll into view, so large tables cost no more than small ones
+class CustomQTableView(QTableView):
+    def __init__(self, model, font = defaultFont):
         super().__init__()
         self.setFont(font)
+        self.setModel(model)
+        # Every row is the same height, so Qt does not need to measure them
+        self.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
 
 # Menu custom class
 class CustomQMenu(QMenu):
@@ -56,9 +85,284 @@ class CustomQMenu(QMenu):
         self.setFont = font
 
 
+# Signals used to pass pushed updates from the WebSocket threads to the GUI thread, with the qualified entity name or the server name
+class PushSignals(QObject):
+    stateChanged = pyqtSignal(str, object)
+    connectionChanged = pyqtSignal(str, bool)
+
+# Draw a trend line from a TrendBuffer with QPainter, using a downsampled copy of the history with at most one point per pixel,
+# so the cost of painting is bounded by the width of the cell
+def paintSparkline(painter, rect, trendBuffer, pen):
+    points = trendBuffer.downsample(max(3, rect.width()))
+    if len(points) == 0:
+        return
+    firstTime = points[0][0]
+    timeRange = points[-1][0] - firstTime
+    minimum = min(point[1] for point in points)
+    valueRange = max(point[1] for point in points) - minimum
+
+    painter.save()
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    painter.setPen(pen)
+    polygon = QPolygonF()
+    for timestamp, value in points:
+        x = rect.left() if timeRange == 0 else rect.left() + (timestamp - firstTime) / timeRange * rect.width()
+        y = rect.center().y() if valueRange == 0 else rect.bottom() - (value - minimum) / valueRange * rect.height()
+        polygon.append(QPointF(x, y))
+    if polygon.size() == 1:
+        painter.drawPoint(polygon.at(0))
+    else:
+        painter.drawPolyline(polygon)
+    painter.restore()
+
+# Delegate used to draw the trend line column of a table from the TrendBuffer held in the model, only when the cell is visible
+class SparklineDelegate(QStyledItemDelegate):
+    def __init__(self, colour=QColor(31, 119, 180), parent=None):
+        super().__init__(parent)
+        self.pen = QPen(colour, 1.5)
+
+    # Draw the cell background and selection as normal, then the trend line on top
+    def paint(self, painter, option, index):
+        super().paint(painter, option, index)
+        trendBuffer = index.data(Qt.ItemDataRole.UserRole)
+        if trendBuffer != None and len(trendBuffer) > 0:
+            with HaMetrics.timer("refresh.plot"):
+                paintSparkline(painter, option.rect.adjusted(2, 2, -2, -2), trendBuffer, self.pen)
+
+# Table model holding a single column of names, such as entity ids or domains
+class EntityListModel(QAbstractTableModel):
+    def __init__(self, names=None):
+        super().__init__()
+        self.names = names if names != None else []
+
+    # Replace every row at once
+    def setNames(self, names):
+        self.beginResetModel()
+        self.names = list(names)
+        self.endResetModel()
+
+    # Return the names in the rows selected in a view of this model, in row order
+    def selectedNames(self, view):
+        rows = sorted({index.row() for index in view.selectionModel().selectedIndexes()})
+        return [self.names[row] for row in rows]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 1
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and index.isValid():
+            return self.names[index.row()]
+        return None
+
+# Table model showing the entities tracked in the main window, reading the text of each cell from the tracked entity when it is drawn
+# Values that could not be refreshed because their server failed are greyed out.
+# If statistics are shown, a column for each rolling statistic sits between the trend and the trend line
+class TrackedEntityModel(QAbstractTableModel):
+    # Class variables to store the column titles and the colour of stale values
+    headers = ["EntityId", "Value", "Trend", "Trend Line"]
+    statisticsHeaders = ["Min", "Max", "Mean", "Std Dev", "Change/min"]
+    staleColour = QColor(128, 128, 128)
+
+    def __init__(self, entityIdDict, trendValDict, statistics=None):
+        super().__init__()
+        self.entityIdDict = entityIdDict
+        self.trendValDict = trendValDict
+        # The entities shown, in row order
+        self.entityIds = []
+        # The RollingStatistics the statistics columns are read from, or None if they are not shown
+        self.statistics = statistics
+        if statistics != None:
+            self.headers = TrackedEntityModel.headers[:3] + TrackedEntityModel.statisticsHeaders + TrackedEntityModel.headers[3:]
+        self.trendColumn = len(self.headers) - 1
+
+    # Replace the rows when entities are added or removed
+    def setEntityIds(self, entityIds):
+        self.beginResetModel()
+        self.entityIds = list(entityIds)
+        self.endResetModel()
+
+    # Tell the views that every cell in a row needs redrawing
+    def rowChanged(self, row):
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.headers) - 1))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entityIds)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.headers[section]
+        return None
+
+    # Return the text of a cell, or the TrendBuffer behind the trend line for the delegate to draw
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        entityId = self.entityIds[index.row()]
+        entityObj = self.entityIdDict.get(entityId)
+        if entityObj == None:
+            return None
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == 0:
+                return entityId
+            if column == 1:
+                return entityValueText(entityObj)
+            if column == 2:
+                return f"{entityObj['trend']}" if "trend" in entityObj else ""
+            if column < self.trendColumn:
+                return self.statisticText(entityId, column - 3)
+        elif role == Qt.ItemDataRole.ForegroundRole and entityObj["stale"]:
+            return self.staleColour
+        elif role == Qt.ItemDataRole.ToolTipRole and entityObj["stale"]:
+            return "The server could not be read, so this is the last value read from it"
+        elif role == Qt.ItemDataRole.UserRole and column == self.trendColumn and entityDomain(entityId) in domainPlotTypes:
+            return self.trendValDict.get(entityId)
+        return None
+
+    # Return the text of one of the statistics of an entity, rounded to two decimal places, with a sign for the rate of change
+    def statisticText(self, entityId, statistic):
+        values = self.statistics.get(entityId) if self.statistics != None else None
+        if values == None:
+            return ""
+        if RollingStatistics.names[statistic] == "ratePerMinute":
+            return f"{values[statistic]:+.2f}"
+        return f"{values[statistic]:.2f}"
+
+# Return the details stored against an entity that is being tracked in the main window
+def newEntityObj(entityId, entityValueObj):
+    return {"rowValue":None, "rowTrend":None, "apiCallObj":entityValueObj, "oldValue": None, "changeKey": None, "dirty": True, "stale": False}
+
+# Return the details stored against each server while its entities are polled: its own scheduler, the worker reading it and its push connection
+def newServerPoll(scheduler):
+    return {"scheduler": scheduler, "entityStatus": None, "worker": None, "pending": False, "started": None, "pushClient": None, "pushConnected": False, "error": None}
+
+# Return the domain of a tracked entity, such as sensor, whichever server it belongs to
+def entityDomain(entityId):
+    return splitEntityId(entityId)[1].split(".")[0]
+
+# Return the text shown for the value of a tracked entity, rounding numbers to two decimal places
+def entityValueText(entityObj):
+    try:
+        return f"{float(entityObj['rowValue']):.2f}"
+    except TypeError:
+        # No value has been read yet
+        return ""
+    except:
+        return f"{entityObj['rowValue']}"
+
+# Return a key that changes whenever an entity's state or attributes change, using last_updated when the API provides it
+def entityChangeKey(entityJson):
+    if "last_updated" in entityJson:
+        return entityJson["last_updated"]
+    return hash(json.dumps(entityJson, sort_keys=True))
+
+# Signals used to pass the results of a background refresh back to the GUI thread, with the name of the server that was read
+class RefreshSignals(QObject):
+    finished = pyqtSignal(str, dict)
+    failed = pyqtSignal(str, str)
+
+# Runnable used to fetch and parse entity values from one server away from the GUI thread
+class RefreshWorker(QRunnable):
+    def __init__(self, entityStatus, entityIds, serverName=""):
+        super().__init__()
+        self.entityStatus = entityStatus
+        self.entityIds = entityIds
+        self.serverName = serverName
+        self.signals = RefreshSignals()
+
+    # Read every entity, work out which values are numeric and pass the results back
+    def run(self):
+        try:
+            with HaMetrics.timer("refresh.fetch"):
+                entityValues = self.entityStatus.readEntities(self.entityIds)
+        except Exception as error:
+            self.signals.failed.emit(self.serverName, str(error))
+            return
+        for entityValue in entityValues.values():
+            entityValue["numericValue"] = None
+            if entityValue["responseCode"] == 200 or entityValue["responseCode"] == 201:
+                try:
+                    entityValue["numericValue"] = float(entityValue["responseJson"]["state"])
+                except (ValueError, TypeError, KeyError):
+                    pass
+        self.signals.finished.emit(self.serverName, entityValues)
+
+# Signals used to pass history read in the background back to the GUI thread
+class BackfillSignals(QObject):
+    historyReady = pyqtSignal(str, object, object)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+# Runnable used to read the recorded history of newly selected entities of one server away from the GUI thread
+# The history of each entity is passed back with its qualified name
+class BackfillWorker(QRunnable):
+    def __init__(self, entityStatus, entityIds, hours, capacity, serverName=""):
+        super().__init__()
+        self.entityStatus = entityStatus
+        self.entityIds = entityIds
+        self.serverName = serverName
+        self.hours = hours
+        self.capacity = capacity
+        self.signals = BackfillSignals()
+
+    # Parse the history as it arrives, passing each entity's samples back as soon as they are complete
+    def run(self):
+        entityId = None
+        timestamps = array("d")
+        values = array("d")
+        try:
+            for changeEntityId, timestamp, state in self.entityStatus.readHistory(self.entityIds, self.hours):
+                if changeEntityId != entityId:
+                    if entityId != None:
+                        self.signals.historyReady.emit(qualifyEntityId(self.serverName, entityId), timestamps, values)
+                    entityId = changeEntityId
+                    timestamps = array("d")
+                    values = array("d")
+                try:
+                    value = float(state)
+                except (TypeError, ValueError):
+                    value = math.nan
+                timestamps.append(timestamp)
+                values.append(value)
+                # Only the newest samples fit in the trend buffer, so there is no need to keep more than that
+                if len(timestamps) >= 2 * self.capacity:
+                    del timestamps[:self.capacity]
+                    del values[:self.capacity]
+            if entityId != None:
+                self.signals.historyReady.emit(qualifyEntityId(self.serverName, entityId), timestamps, values)
+        except Exception as error:
+            self.signals.failed.emit(str(error))
+        self.signals.finished.emit(self)
+
+# Signals used to pass the result of reading each server's entities, and then of every server, back to the GUI thread
+class CatalogSignals(QObject):
+    serverRead = pyqtSignal(object, object)
+    finished = pyqtSignal(object)
+
+# Runnable used to read the entities of every server away from the GUI thread
+# Each server's catalog is updated and saved to the snapshot as it is read, and the changes are left in its entityStatus.
+# Each server is passed back as soon as it has been read, so a slow or unreachable server does not hold up the others
+class CatalogWorker(QRunnable):
+    def __init__(self, servers):
+        super().__init__()
+        self.servers = servers
+        self.signals = CatalogSignals()
+
+    def run(self):
+        self.signals.finished.emit(self.servers.readAllEntities(onServerRead=self.signals.serverRead.emit))
+
 # Subclass QMainWindow to customize your application's main window
 class MainWindow(QMainWindow):
-    def __init__(self, windowWidth = 800, windowHeight = 500, font=defaultFont):
+    # Class variable to store how many hours of history are read from the server when entities are selected
+    backfillHours = 6.0
+
+    def __init__(self, windowWidth = 800, windowHeight = 500, font=defaultFont, historyStore=None, scheduler=None, servers=None, statistics=None, trendBuffer=None):
         super().__init__()
 
         self.setWindowTitle("Home Assistant API Client")
@@ -68,13 +372,42 @@ class MainWindow(QMainWindow):
         # Instance variables to store useful information
         self.entityIdDict = {}
         self.trendValDict = {}
-        self.plotList = []
-
-        # Set a 5 second timer
+        # Each entity's trend history is kept in a copy of this empty TrendBuffer, so they all have the same capacity and retention
+        self.trendBuffer = trendBuffer if trendBuffer != None else TrendBuffer()
+        # Store used to keep the trend history and selected entities on disk, if one is given
+        self.historyStore = historyStore
+        # How many rows changed in the last redraw
+        self.changedRowCount = 0
+        self.unchangedRowCount = 0
+
+        # Every configured server. Tracked entities are named as by qualifyEntityId, so entities of different servers never clash
+        self.servers = servers if servers != None else HaServerGroup()
+
+        # Each entity is polled on its own schedule, with a timer set for whenever the next one is due
+        # Each server has its own copy of the scheduler, so it has its own request budget
+        self.scheduler = scheduler if scheduler != None else HaPollScheduler()
         self.checkThreadTimer = QTimer(self)
-        self.checkThreadTimer.setInterval(5000) #5 seconds
+        self.checkThreadTimer.setSingleShot(True)
         self.checkThreadTimer.timeout.connect(self.updateTableValues)
-        self.checkThreadTimer.start()
+
+        # Dict of server name to the details from newServerPoll. Each server's values are read by its own background worker,
+        # so a slow or unreachable server does not hold up the others
+        self.serverPolls = {}
+        # History is read by background workers, which are kept here until they finish
+        self.backfillWorkers = []
+        # The workers spend most of their time waiting for servers, so there is a thread for each server to refresh and read history
+        # however few processors there are, and a server that does not answer only holds up its own worker
+        self.threadPool = QThreadPool(self)
+        self.threadPool.setMaxThreadCount(max(self.threadPool.maxThreadCount(), 2 * len(self.servers) + 2))
+
+        # Pushed state changes arrive on background threads and are passed to the GUI thread using signals
+        self.pushSignals = PushSignals()
+        self.pushSignals.stateChanged.connect(self.pushedStateChanged)
+        self.pushSignals.connectionChanged.connect(self.pushConnectionChanged)
+        self.redrawTimer = QTimer(self)
+        self.redrawTimer.setSingleShot(True)
+        self.redrawTimer.setInterval(250)
+        self.redrawTimer.timeout.connect(self.drawTable)
 
         # Set the menu bar up 
         menuBar = self.menuBar()
@@ -90,16 +423,18 @@ class MainWindow(QMainWindow):
 
         # Create the widgets and layouts and display on the screen
         windowLabel = CustomQLabel("Selected Entities and Values")
-        self.entityTable = CustomQTableWidget()
-
-        # Set the table up on the table on the main window
-        numColumns = 4
-        self.entityTable.setColumnCount(numColumns)
+        # Rolling statistics of each entity's recent values are shown if they are given, worked out once per redraw for every entity
+        self.statistics = statistics
+        self.showStatistics = statistics != None
+        self.entityModel = TrackedEntityModel(self.entityIdDict, self.trendValDict, statistics)
+        self.entityTable = CustomQTableView(self.entityModel)
+
+        # Set the table up on the table on the main window, drawing the trend lines with a delegate
+        self.sparklineDelegate = SparklineDelegate(parent=self.entityTable)
+        self.entityTable.setItemDelegateForColumn(self.entityModel.trendColumn, self.sparklineDelegate)
+        # The text columns are sized to fit once per redraw in drawRows, as sizing them on every changed row is slow
         header = self.entityTable.horizontalHeader()
-        for i in range(0, numColumns-1):     
-            header.setSectionResizeMode(i, QHeaderView.ResizeMode.ResizeToContents)
-        header.resizeSection(3,200)
-        self.entityTable.setHorizontalHeaderLabels(["EntityId", "Value", "Trend", "Trend Line"])
+        header.resizeSection(self.entityModel.trendColumn, 200)
         
         # Add items to a layout that can be displayed
         verticalLayout = QVBoxLayout()
@@ -112,13 +447,36 @@ class MainWindow(QMainWindow):
         widget.setLayout(verticalLayout)
         self.setCentralWidget(widget)
 
+        # Summarise the servers that cannot be read in the status bar, rather than interrupting refreshes with a dialog
+        self.errorLabel = QLabel("")
+        self.statusBar().addPermanentWidget(self.errorLabel, 1)
+
+        # Show how long each part of a refresh takes in the status bar, if metrics are turned on
+        if HaMetrics.enabled:
+            self.metricsLabel = QLabel("")
+            self.statusBar().addPermanentWidget(self.metricsLabel)
+            self.metricsTimer = QTimer(self)
+            self.metricsTimer.setInterval(2000)
+            self.metricsTimer.timeout.connect(self.updateMetrics)
+            self.metricsTimer.start()
+
     # Function to run when the close button is pressed on the main window
     def closeEvent(self, event):
+        for serverPoll in self.serverPolls.values():
+            if serverPoll["pushClient"] != None:
+                serverPoll["pushClient"].stop()
+        HaAsyncRunner.shutdown()
+        if self.historyStore != None:
+            self.historyStore.close()
         if configWindow.isVisible():
             configWindow.close()
         if entityWindow.isVisible():
             entityWindow.close()
 
+    # Show the latest timings of each part of a refresh in the status bar
+    def updateMetrics(self):
+        self.metricsLabel.setText(HaMetrics.summaryLine(["request", "refresh.fetch", "refresh.trend", "refresh.table", "refresh.plot", "refresh.cycle"]))
+
     # Show the config window when the function is called
     def showConfigWindow(self):
         configWindow.show()
@@ -127,85 +485,306 @@ class MainWindow(QMainWindow):
     def showSelectEntitiesWindow(self):
         entityWindow.show()
 
-    # Update the contents of the table when the function is called
+    # Return the polling details of a server, creating them the first time one of its entities is tracked
+    def serverPoll(self, serverName):
+        if serverName not in self.serverPolls:
+            self.serverPolls[serverName] = newServerPoll(self.scheduler.copy())
+        return self.serverPolls[serverName]
+
+    # Return True while any server is being read in the background
+    def refreshRunning(self):
+        return any(serverPoll["worker"] != None for serverPoll in self.serverPolls.values())
+
+    # Start a background refresh of the entities that are due on each server when the function is called
     def updateTableValues(self):
 
-        # List of entity types that can be plotted
-        domainPlotTypes = ["input_number", "input_text", "number", "sensor"]
-
-        # For any previously drawn plots, close them as they are created new each time the table is updated
-        for figure in self.plotList:
-            plot.close(figure)
-
-        # If entities have been selected, update the table
-        if len(self.entityIdDict) > 0:
-            # Set the number of rows in the table
-            self.entityTable.setRowCount(len(self.entityIdDict))
-            counter = 0
-            # For each entity, pull the latest value and use it
-            for entityId in self.entityIdDict:
-                entityObj = self.entityIdDict[entityId]
-                entityObj["oldValue"] = entityObj["rowValue"]
-                entityValue = entityObj["apiCallObj"].readEntity()
-                if entityValue['responseCode'] == 200 or entityValue['responseCode'] == 201:
-                    entityObj["rowValue"] = entityValue['responseJson']['state']
-                else:
-                    messageBox = CustomQMessageBox("Connection Error", f"Connection Error: {entityValue['responseCode']}. Check API details and try again.")
-                    print(entityValue["responseCode"])
-                
-                # Work out the integer value (all are returned as strings from the API)
-                # Set the trend value if possible and this can be displayed
-                if entityId.split(".")[0] in domainPlotTypes:
-                    trend = None
-                    trendVal=""
-                    try:
-                        oldValueInt = float(entityObj["oldValue"])
-                        newValueInt = float(entityObj["rowValue"])
-                        trendVal = newValueInt
-                        if oldValueInt < newValueInt:
-                            trend = "↗"
-                        elif newValueInt < oldValueInt:
-                            trend = "↘"
-                        else:
-                            trend = "="
-                    except:
-                        trend = ""
-                        trendVal = "NaN"
-                    entityObj["trend"] = trend
-
-                    # If no trend values are available for an entity, create a new list within the dict
-                    if trendVal != "" and entityId not in self.trendValDict:
-                        self.trendValDict[entityId] = []
-                    
-                    # Append to the list if the calculated value is not a blank string
-                    if trendVal != "":
-                        self.trendValDict[entityId].append(trendVal)
-
-                    # Create a plot based on the previously returned data
-                    figure = plot.figure()
-                    canvas = FigureCanvasQTAgg(figure)
-                    axes = figure.add_subplot(111)
-                    axes.set_axis_off()
-                    axes.set_alpha(0)
-                    axes.plot(self.trendValDict[entityId])
-                    
-                    self.plotList.append(figure)
-
-                # Update the table accordingly
-                self.entityTable.setItem(counter, 0, QTableWidgetItem(entityId))
-                try:
-                    self.entityTable.setItem(counter, 1, QTableWidgetItem(f"{float(entityObj['rowValue']):.2f}"))
-                except:
-                    self.entityTable.setItem(counter, 1, QTableWidgetItem(f"{entityObj['rowValue']}"))
-                if "trend" in entityObj:
-                    self.entityTable.setItem(counter, 2, QTableWidgetItem(f"{entityObj['trend']}"))
-                else:
-                    self.entityTable.setItem(counter, 2, QTableWidgetItem(""))
-                if entityId.split(".")[0] in domainPlotTypes and len(self.trendValDict[entityId]) > 0:
-                    self.entityTable.setCellWidget(counter, 3, canvas)
-                else:
-                    self.entityTable.setCellWidget(counter, 3, QWidget())
-                counter += 1
+        # Group the tracked entities by server, keeping the HaEntityStatus used to read each one
+        serverEntities = {serverName: {} for serverName in self.serverPolls}
+        for entityId, entityObj in self.entityIdDict.items():
+            serverName, serverEntityId = splitEntityId(entityId)
+            serverEntities.setdefault(serverName, {})[serverEntityId] = entityObj["apiCallObj"]
+
+        for serverName, entityStatuses in serverEntities.items():
+            serverPoll = self.serverPoll(serverName)
+            # Newly selected entities are due straight away, and deselected ones are no longer polled
+            serverPoll["scheduler"].setEntities(entityStatuses)
+
+            # Only one refresh runs at a time for each server. If one is already running, refresh again as soon as it finishes
+            if serverPoll["worker"] != None:
+                serverPoll["pending"] = True
+                continue
+            if len(entityStatuses) == 0:
+                continue
+            # Changes to the entities of a server with a push connection arrive over it, so only entities that have never been read are polled
+            include = None
+            if serverPoll["pushConnected"]:
+                include = {serverEntityId for serverEntityId in entityStatuses if self.entityIdDict[qualifyEntityId(serverName, serverEntityId)]["changeKey"] == None}
+                if len(include) == 0:
+                    continue
+
+            # Pull the latest value of the due entities together, which uses a single request when many are due
+            entityStatus = next(iter(entityStatuses.values()))
+            entityIds = serverPoll["scheduler"].takeDue(bulkRead=entityStatus.useBulkRead, include=include)
+            if len(entityIds) > 0:
+                serverPoll["entityStatus"] = entityStatus
+                serverPoll["worker"] = RefreshWorker(entityStatus, entityIds, serverName)
+                serverPoll["started"] = time.perf_counter()
+                serverPoll["worker"].signals.finished.connect(self.refreshFinished)
+                serverPoll["worker"].signals.failed.connect(self.refreshFailed)
+                self.threadPool.start(serverPoll["worker"])
+        self.drawTable()
+        self.schedulePoll()
+
+    # Set the timer for when the next entity is due, leaving out servers that are being read or whose changes are being pushed
+    def schedulePoll(self):
+        dueTimes = []
+        for serverPoll in self.serverPolls.values():
+            if serverPoll["worker"] == None and not serverPoll["pushConnected"]:
+                dueIn = serverPoll["scheduler"].nextDueIn()
+                if dueIn != None:
+                    dueTimes.append(dueIn)
+        if len(dueTimes) == 0:
+            self.checkThreadTimer.stop()
+        else:
+            self.checkThreadTimer.start(int(min(dueTimes) * 1000) + 1)
+
+    # Apply the values read from a server by the background refresh
+    def refreshFinished(self, serverName, entityValues):
+        serverPoll = self.serverPolls[serverName]
+        errorCodes = set()
+        # Entities read together are scheduled from the same time, so they stay due together while their intervals match
+        now = time.monotonic()
+        with HaMetrics.timer("refresh.trend"):
+            for serverEntityId in entityValues:
+                entityId = qualifyEntityId(serverName, serverEntityId)
+                # Entities may have been deselected while the refresh was running
+                if entityId in self.entityIdDict:
+                    oldChangeKey = self.entityIdDict[entityId]["changeKey"]
+                    success = self.applyEntityValue(entityId, entityValues[serverEntityId])
+                    if not success:
+                        errorCodes.add(str(entityValues[serverEntityId]["responseCode"]))
+                    # Poll the entity sooner if it changed, later if it did not and back off if it could not be read
+                    serverPoll["scheduler"].recordResult(serverEntityId, self.entityIdDict[entityId]["changeKey"] != oldChangeKey, error=not success, now=now)
+        serverPoll["error"] = ", ".join(sorted(errorCodes)) if len(errorCodes) > 0 else None
+        self.showServerErrors()
+        self.refreshDone(serverName)
+
+    # Report a refresh that could not reach a server without interrupting the user
+    def refreshFailed(self, serverName, message):
+        serverPoll = self.serverPolls[serverName]
+        serverPoll["error"] = message
+        for entityId in serverPoll["worker"].entityIds:
+            serverPoll["scheduler"].recordResult(entityId, False, error=True)
+        self.showServerErrors()
+        self.refreshDone(serverName)
+
+    # Show the errors from the last refresh of each server in the status bar, with whether requests to it have stopped and how many values are stale
+    def showServerErrors(self):
+        errors = []
+        for serverName, serverPoll in self.serverPolls.items():
+            if serverPoll["error"] != None:
+                error = serverPoll["error"]
+                if serverPoll["entityStatus"] != None and serverPoll["entityStatus"].circuitState() != "closed":
+                    error += ", not responding"
+                staleCount = sum(1 for entityId, entityObj in self.entityIdDict.items() if entityObj["stale"] and splitEntityId(entityId)[0] == serverName)
+                if staleCount > 0:
+                    error += f", {staleCount} stale"
+                errors.append(error if serverName == "" else f"{serverName} {error}")
+        if len(errors) > 0:
+            self.errorLabel.setText(f"Connection Error: {'; '.join(errors)}. Check API details.")
+        else:
+            self.errorLabel.setText("")
+
+    # Report history that could not be read without interrupting the user
+    def backfillFailed(self, message):
+        self.statusBar().showMessage(f"Could not read history: {message}")
+
+    # Allow the next refresh of a server to start, running it straight away if one was requested in the meantime
+    def refreshDone(self, serverName):
+        serverPoll = self.serverPolls[serverName]
+        if serverPoll["started"] != None:
+            HaMetrics.record("refresh.cycle", time.perf_counter() - serverPoll["started"])
+            serverPoll["started"] = None
+        serverPoll["worker"] = None
+        if serverPoll["pending"]:
+            serverPoll["pending"] = False
+            self.updateTableValues()
+        else:
+            self.drawTable()
+            self.schedulePoll()
+
+    # Store a value returned from the API against an entity and work out its trend, returning False if the API reported an error
+    def applyEntityValue(self, entityId, entityValue):
+        entityObj = self.entityIdDict[entityId]
+        success = entityValue['responseCode'] == 200 or entityValue['responseCode'] == 201
+        # Keep showing the last value while the server cannot be read, marked as stale, until a value is read again
+        if entityObj["stale"] != (not success and entityValue.get("stale", False)):
+            entityObj["stale"] = not entityObj["stale"]
+            entityObj["dirty"] = True
+        if not success:
+            print(entityValue["responseCode"])
+            return success
+
+        # Skip values that have not changed since they were last read, so their row is left as it is
+        changeKey = entityChangeKey(entityValue['responseJson'])
+        if changeKey == entityObj["changeKey"]:
+            return success
+        entityObj["changeKey"] = changeKey
+        entityObj["dirty"] = True
+        entityObj["oldValue"] = entityObj["rowValue"]
+        entityObj["rowValue"] = entityValue['responseJson']['state']
+
+        # Work out the integer value (all are returned as strings from the API)
+        # Set the trend value if possible and this can be displayed
+        if entityDomain(entityId) in domainPlotTypes:
+            # The new value is worked out first, so it is stored even when there is no old value to compare it with, such as on the first read
+            try:
+                newValueInt = entityValue["numericValue"] if entityValue.get("numericValue") != None else float(entityObj["rowValue"])
+            except (TypeError, ValueError):
+                newValueInt = math.nan
+            try:
+                oldValueInt = float(entityObj["oldValue"])
+            except (TypeError, ValueError):
+                oldValueInt = math.nan
+            if math.isnan(newValueInt) or math.isnan(oldValueInt):
+                trend = ""
+            elif oldValueInt < newValueInt:
+                trend = "↗"
+            elif newValueInt < oldValueInt:
+                trend = "↘"
+            else:
+                trend = "="
+            entityObj["trend"] = trend
+
+            # If no trend values are available for an entity, create a new buffer within the dict
+            if entityId not in self.trendValDict:
+                self.trendValDict[entityId] = self.trendBuffer.copy()
+
+            # Append the value at the time it was last updated. Values that are not numbers are stored as NaN, leaving a gap in the trend line
+            timestamp = entityTimestamp(entityValue['responseJson'])
+            self.trendValDict[entityId].append(newValueInt, timestamp)
+            if self.showStatistics:
+                self.statistics.add(entityId, timestamp, newValueInt)
+            if self.historyStore != None:
+                self.historyStore.addSample(entityId, timestamp, newValueInt)
+        return success
+
+    # Redraw the table from the values stored against each entity, only telling the view about rows that have changed
+    def drawTable(self):
+        with HaMetrics.timer("refresh.table"):
+            self.drawRows()
+
+    # Reset the model if entities have been added or removed, otherwise tell the view which rows have changed
+    def drawRows(self):
+
+        # If entities have been added or removed, every row is reset. Otherwise only changed rows are redrawn
+        entityIds = list(self.entityIdDict)
+        rebuild = entityIds != self.entityModel.entityIds
+        if rebuild:
+            self.entityModel.setEntityIds(entityIds)
+            if self.statistics != None:
+                self.statistics.retain(entityIds)
+
+        # Work out the statistics of every entity together, redrawing the rows whose statistics changed as samples arrived or left the window
+        if self.statistics != None:
+            with HaMetrics.timer("refresh.statistics"):
+                for entityId in self.statistics.update():
+                    if entityId in self.entityIdDict:
+                        self.entityIdDict[entityId]["dirty"] = True
+
+        self.changedRowCount = 0
+        self.unchangedRowCount = 0
+        for row in range(len(entityIds)):
+            entityObj = self.entityIdDict[entityIds[row]]
+            if rebuild or entityObj["dirty"]:
+                if not rebuild:
+                    self.entityModel.rowChanged(row)
+                entityObj["dirty"] = False
+                self.changedRowCount += 1
+            else:
+                self.unchangedRowCount += 1
+        if self.changedRowCount > 0:
+            for column in range(0, self.entityModel.trendColumn):
+                self.entityTable.resizeColumnToContents(column)
+
+    # Track the entities that were selected last time and fill their trend lines from the history store
+    # Entities of servers that are no longer configured are left out
+    def restoreHistory(self):
+        if self.historyStore == None:
+            return
+        entityIds = [entityId for entityId in self.historyStore.loadSelection() if self.servers.find(entityId)[0] != None]
+        samples = self.historyStore.readRange(entityIds, time.time() - self.historyStore.restoreHours * 3600, limit=self.trendBuffer.capacity)
+        for entityId in entityIds:
+            server, serverEntityId = self.servers.find(entityId)
+            self.entityIdDict[entityId] = newEntityObj(entityId, server.entity(serverEntityId))
+            timestamps, values = samples[entityId]
+            if len(timestamps) > 0 and entityDomain(entityId) in domainPlotTypes:
+                self.trendValDict[entityId] = self.trendBuffer.copy()
+                self.trendValDict[entityId].extend(timestamps, values)
+                if self.showStatistics:
+                    self.statistics.load(entityId, timestamps, values)
+        self.updateTableValues()
+
+    # Read the recent history of newly selected entities from their servers in the background, so their trend lines start filled
+    def backfillHistory(self, entityIds):
+        if self.backfillHours <= 0:
+            return
+        # Each server's history is read by its own worker
+        serverEntityIds = {}
+        for entityId in entityIds:
+            if entityDomain(entityId) in domainPlotTypes:
+                serverName, serverEntityId = splitEntityId(entityId)
+                serverEntityIds.setdefault(serverName, []).append(serverEntityId)
+        for serverName, entityIds in serverEntityIds.items():
+            entityStatus = self.entityIdDict[qualifyEntityId(serverName, entityIds[0])]["apiCallObj"]
+            worker = BackfillWorker(entityStatus, entityIds, self.backfillHours, self.trendBuffer.capacity, serverName)
+            worker.signals.historyReady.connect(self.historyReady)
+            worker.signals.failed.connect(self.backfillFailed)
+            worker.signals.finished.connect(self.backfillWorkers.remove)
+            self.backfillWorkers.append(worker)
+            self.threadPool.start(worker)
+
+    # Merge history read from the server into an entity's trend line
+    def historyReady(self, entityId, timestamps, values):
+        if entityId in self.entityIdDict:
+            if entityId not in self.trendValDict:
+                self.trendValDict[entityId] = self.trendBuffer.copy()
+            self.trendValDict[entityId].merge(timestamps, values)
+            if self.showStatistics:
+                self.statistics.load(entityId, self.trendValDict[entityId].timestamps(), self.trendValDict[entityId].values())
+            self.entityIdDict[entityId]["dirty"] = True
+            if not self.redrawTimer.isActive():
+                self.redrawTimer.start()
+
+    # Start receiving pushed state changes from a server, polling it only while the connection is down
+    def startPushUpdates(self, server):
+        serverPoll = self.serverPoll(server.name)
+        if serverPoll["pushClient"] != None:
+            serverPoll["pushClient"].stop()
+        serverName = server.name
+        serverPoll["pushClient"] = HaWebSocketClient(server.uri, server.apiKey,
+            onStateChanged=lambda entityId, newState: self.pushSignals.stateChanged.emit(qualifyEntityId(serverName, entityId), newState),
+            onConnectionChanged=lambda connected: self.pushSignals.connectionChanged.emit(serverName, connected))
+        serverPoll["pushClient"].start()
+
+    # Apply a pushed state change to a tracked entity and redraw the table shortly afterwards
+    def pushedStateChanged(self, entityId, newState):
+        if entityId in self.entityIdDict and newState != None:
+            self.applyEntityValue(entityId, {"responseCode": 200, "responseJson": newState})
+            # Several changes often arrive together, so wait briefly and redraw the table once
+            if not self.redrawTimer.isActive():
+                self.redrawTimer.start()
+
+    # Stop polling a server while its changes are being pushed and start again if the connection drops
+    def pushConnectionChanged(self, serverName, connected):
+        serverPoll = self.serverPoll(serverName)
+        serverPoll["pushConnected"] = connected
+        if connected:
+            # Catch up with anything that changed while the connection was down
+            serverPoll["scheduler"].pollNow()
+            self.updateTableValues()
+        else:
+            self.schedulePoll()
 
 # Subclass QMainWindow to customize your application's entity selection window
 class EntityWindow(QMainWindow):
@@ -218,13 +797,23 @@ class EntityWindow(QMainWindow):
 
         #Create the widgets to display and add them to a layout
         self.numEntitiesLabel = CustomQLabel("Number of Entities: ")
-        self.entitiesTable = CustomQTableWidget()
+        self.searchText = CustomQLineEdit("")
+        self.searchText.setPlaceholderText("Type to search entities")
+        self.searchText.setClearButtonEnabled(True)
+        # The entities in the selected domains, which the search text narrows down
+        self.domainEntityIds = []
+        self.entitiesModel = EntityListModel()
+        self.entitiesTable = CustomQTableView(self.entitiesModel)
+        self.entitiesTable.verticalHeader().setVisible(False)
+        self.entitiesTable.horizontalHeader().setVisible(False)
+        self.entitiesTable.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
 
         self.mainWindow = mainWindow
 
         # Create our layout to store the widgets
         verticalLayout = QVBoxLayout()
         verticalLayout.addWidget(self.numEntitiesLabel)
+        verticalLayout.addWidget(self.searchText)
         verticalLayout.addWidget(self.entitiesTable)
 
         # Set the windows content
@@ -233,42 +822,61 @@ class EntityWindow(QMainWindow):
         self.setCentralWidget(widget)
 
         # Link widgets to function calls
-        self.entitiesTable.itemClicked.connect(self.selectEntities)
-        self.entitiesTable.itemClicked.connect(self.mainWindow.updateTableValues)
+        self.entitiesTable.clicked.connect(self.selectEntities)
+        self.entitiesTable.clicked.connect(self.mainWindow.updateTableValues)
+        self.searchText.textChanged.connect(self.filterEntities)
+
+    # Show the entities of the selected domains, keeping any search text that has been typed
+    def showEntities(self, entityIds):
+        self.domainEntityIds = entityIds
+        self.filterEntities()
+
+    # Narrow the list down to the entities matching the search text, using the catalog's search index
+    def filterEntities(self):
+        text = self.searchText.text()
+        if text.strip() == "":
+            entityIds = self.domainEntityIds
+        else:
+            matches = self.mainWindow.servers.search(text)
+            entityIds = [entityId for entityId in self.domainEntityIds if entityId in matches]
+        self.entitiesModel.setNames(entityIds)
+        self.selectTrackedRows()
+
+        # Update the label on the entities window
+        if len(entityIds) == len(self.domainEntityIds):
+            self.numEntitiesLabel.setText("Number of Entities: " + str(len(entityIds)))
+        else:
+            self.numEntitiesLabel.setText(f"Number of Entities: {len(entityIds)} of {len(self.domainEntityIds)}")
+
+    # Select the rows of entities that are already being tracked, so the list shows what the main window holds
+    def selectTrackedRows(self):
+        selection = QItemSelection()
+        for row, entityId in enumerate(self.entitiesModel.names):
+            if entityId in self.mainWindow.entityIdDict:
+                index = self.entitiesModel.index(row, 0)
+                selection.select(index, index)
+        self.entitiesTable.selectionModel().select(selection, QItemSelectionModel.SelectionFlag.ClearAndSelect)
 
     # Function to return the entity IDs that are selected from the table and update the entityIdDict accoridngly with objects that allow the value to be called simply
     def selectEntities(self):
-        localEntityIdList = []
-        selectedCells = self.entitiesTable.selectedRanges()
-
-        for selectedCell in selectedCells:
-            topRow = selectedCell.topRow()
-            bottomRow = selectedCell.bottomRow()
-
-            for i in range(topRow, bottomRow+1):
-                entityId = self.entitiesTable.item(i, 0).text()
-                if entityId not in mainWindow.entityIdDict:
-                    mainWindow.entityIdDict[entityId] = {"rowLabel":QTableWidgetItem(entityId), "rowValue":None, "rowTrend":None, "apiCallObj":None, "oldValue": None}
-                    entityValueObj = HaEntityStatus(configWindow.haServerAddressText.text(), configWindow.haApiKeyText.text(),entityId)
-                    mainWindow.entityIdDict[entityId]["apiCallObj"] = entityValueObj
-                    
-                    try:
-                        readEntityIdValue = mainWindow.entityIdDict[entityId]["apiCallObj"].readEntity()
-                        if readEntityIdValue['responseCode'] == 200 or readEntityIdValue['responseCode'] == 201:
-                            mainWindow.entityIdDict[entityId]["rowValue"] = readEntityIdValue['responseJson']['state']
-                        else:
-                            errorBox = CustomQMessageBox("Connection Error",f"Could not connect. Connection error: {readEntityIdValue['responseCode']}. Check the API details and try again.")
-                    except (requests.exceptions.InvalidURL, requests.exceptions.ConnectionError):
-                        errorBox = CustomQMessageBox("Connection Error","Invalid URL. Please check the details.")
-                
-                # Append the entityId if it is not already in the list
-                if entityId not in localEntityIdList:
-                    localEntityIdList.append(entityId)
-
-        #Now check to see if the dict has items that have not been selected and remove them
+        localEntityIdList = self.entitiesModel.selectedNames(self.entitiesTable)
+        newEntityIdList = []
+
+        for entityId in localEntityIdList:
+            if entityId not in mainWindow.entityIdDict:
+                server, serverEntityId = mainWindow.servers.find(entityId)
+                entityValueObj = server.entity(serverEntityId)
+                mainWindow.entityIdDict[entityId] = newEntityObj(entityId, entityValueObj)
+                newEntityIdList.append(entityId)
+                # The value itself is read by the background refresh that runs when the table is clicked
+        localEntityIds = set(localEntityIdList)
+
+        #Now check to see if the dict has items that are shown but have not been selected and remove them
+        # Entities hidden by the search text or in other domains are left as they are
+        shownEntityIds = set(self.entitiesModel.names)
         entitiesToRemove = []
         for entityId in mainWindow.entityIdDict:
-            if entityId not in localEntityIdList:
+            if entityId in shownEntityIds and entityId not in localEntityIds:
                 entitiesToRemove.append(entityId)
 
         #Remove any entityIds from the overall list that we have 
@@ -277,6 +885,13 @@ class EntityWindow(QMainWindow):
             if entityToRemove in mainWindow.trendValDict:
                 mainWindow.trendValDict.pop(entityToRemove)
 
+        # Fill the trend lines of newly selected entities from the history held by the server
+        mainWindow.backfillHistory(newEntityIdList)
+
+        # Remember the selection so it can be restored next time
+        if mainWindow.historyStore != None:
+            mainWindow.historyStore.saveSelection(list(mainWindow.entityIdDict))
+
 # Subclass QMainWindow to customize your application's config window
 class ConfigWindow(QMainWindow):
     def __init__(self, entityWindow, uri, apiKey, windowWidth = 600, windowHeight = 500):
@@ -310,11 +925,21 @@ class ConfigWindow(QMainWindow):
         haApiKeyHLayout.addWidget(haApiKeyLabel)
         haApiKeyHLayout.addWidget(self.haApiKeyText)
 
+        # Any other servers are set in the config file and are connected to at the same time
+        otherServers = [f"{server.name} ({server.uri})" for server in entityWindow.mainWindow.servers if server.name != ""]
+        otherServersLabel = CustomQLabel("Also connecting to: " + ", ".join(otherServers))
+        otherServersLabel.setWordWrap(True)
+        otherServersLabel.setVisible(len(otherServers) > 0)
+
         connectApiButton = CustomQPushButton("Connect To Home Assistant")
 
         # Create the widgets to display the list of entity types
         entityTypeLabel = CustomQLabel("Select the type of entities to select from:")
-        self.entityTypeTable = CustomQTableWidget()
+        self.entityTypeModel = EntityListModel()
+        self.entityTypeTable = CustomQTableView(self.entityTypeModel)
+        self.entityTypeTable.verticalHeader().setVisible(False)
+        self.entityTypeTable.horizontalHeader().setVisible(False)
+        self.entityTypeTable.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
 
         # Add widgets to a layout
         verticalLayout = QVBoxLayout()
@@ -322,6 +947,7 @@ class ConfigWindow(QMainWindow):
         verticalLayout.addWidget(haServerDetailsLabel)
         verticalLayout.addLayout(haServerHLayout)
         verticalLayout.addLayout(haApiKeyHLayout)
+        verticalLayout.addWidget(otherServersLabel)
         verticalLayout.addWidget(connectApiButton)
         verticalLayout.addWidget(whiteSpace)
         verticalLayout.addWidget(entityTypeLabel)
@@ -334,89 +960,112 @@ class ConfigWindow(QMainWindow):
 
         # Connect the two buttons to the functions
         connectApiButton.clicked.connect(self.connectToApi)
-        self.entityTypeTable.itemClicked.connect(self.selectEntityTypes)
+        self.entityTypeTable.clicked.connect(self.selectEntityTypes)
+
+        # Worker reading the entities of every server in the background, and whether they should be read again once it finishes
+        self.catalogWorker = None
+        self.catalogPending = False
+        # Servers that could not be read and the number of entities added, removed and renamed by the servers read so far
+        self.catalogErrors = []
+        self.catalogChanges = {"added": 0, "removed": 0, "renamed": 0}
 
-    # When the Connect to API button is selected, read the entities from the API and update the list of domains from this list
+    # When the Connect to API button is selected, list the entities saved from last time straight away and read them again from every server in the background
     def connectToApi(self):
         print("Connecting to API")
 
-        uriEntered = self.haServerAddressText.text()
-        apiEntered = self.haApiKeyText.text()
-        print("Connecting to the API...")
-        allEntities = HaEntityStatus(uriEntered, apiEntered)
+        # The details typed in are used for the first server, and any others come from the config file
+        servers = self.entityWindow.mainWindow.servers
+        servers.setServer("", self.haServerAddressText.text(), self.haApiKeyText.text())
+        self.showSavedEntities()
+        self.refreshEntities()
+
+    # Fill the catalog of each server that has not been read yet from the snapshot, and list its domains straight away
+    def showSavedEntities(self):
+        servers = self.entityWindow.mainWindow.servers
+        servers.loadSnapshot()
+        self.showDomains(servers.domainNames())
+
+    # Show a new list of domains, keeping the selected domains that are still in it
+    def showDomains(self, domainNames):
+        if domainNames == self.entityTypeModel.names:
+            return
+        selectedDomains = set(self.entityTypeModel.selectedNames(self.entityTypeTable))
+        self.entityTypeModel.setNames(domainNames)
+        selection = QItemSelection()
+        for row, domain in enumerate(domainNames):
+            if domain in selectedDomains:
+                index = self.entityTypeModel.index(row, 0)
+                selection.select(index, index)
+        self.entityTypeTable.selectionModel().select(selection, QItemSelectionModel.SelectionFlag.ClearAndSelect)
+
+    # Read the entities of every server in the background. If a read is already running, another is started when it finishes
+    def refreshEntities(self):
+        if self.catalogWorker != None:
+            self.catalogPending = True
+            return
         print("Reading entities...")
-        try:
-            allEntities.readAllEntities()
-
-        # If possible to connect to the API create a list of entity domains and populate the entity domain table
-            if allEntities.responseCode >= 200 and allEntities.responseCode <= 400:
-
-                global entitiesJson 
-                entitiesJson = allEntities.entities
-
-                # Sorted the list of entity_ids
-                entitiesJson = sorted(entitiesJson, key=lambda x:x['entity_id'])
-                entityDomains = []
-
-                for entity in entitiesJson:
-                    if "." in entity["entity_id"]:
-                        entityDomain = entity["entity_id"].split('.')[0]
-                        if entityDomain not in entityDomains:
-                            entityDomains.append(entityDomain)
-                
-                # Set the size of the table and configure the table
-                self.entityTypeTable.setRowCount(len(entityDomains))
-                self.entityTypeTable.setColumnCount(1)
-                self.entityTypeTable.verticalHeader().setVisible(False)
-                self.entityTypeTable.horizontalHeader().setVisible(False)
-
-                header = self.entityTypeTable.horizontalHeader()       
-                header.setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
-
-                # Populate the entity domain table
-                for i in range(len(entityDomains)):
-                    self.entityTypeTable.setItem(i, 0, QTableWidgetItem(entityDomains[i]))
-            
-            else:
-                print ("Could not connect to the API")
-                errorBox = CustomQMessageBox("API Connection Error","Could not connect to the API. Please check the credentials.")
+        self.statusBar().showMessage("Reading entities...")
+        self.catalogErrors = []
+        self.catalogChanges = {"added": 0, "removed": 0, "renamed": 0}
+        self.catalogWorker = CatalogWorker(self.entityWindow.mainWindow.servers)
+        self.catalogWorker.signals.serverRead.connect(self.serverEntitiesRead)
+        self.catalogWorker.signals.finished.connect(self.entitiesRead)
+        self.entityWindow.mainWindow.threadPool.start(self.catalogWorker)
+
+    # Apply only what changed since the entities of a server were last listed, as soon as that server has been read
+    def serverEntitiesRead(self, server, result):
+        servers = self.entityWindow.mainWindow.servers
+        if isinstance(result, Exception):
+            self.catalogErrors.append(f"Could not reach {server.uri}. Please check the details.")
+        elif result < 200 or result > 400:
+            self.catalogErrors.append(f"Could not connect to {server.uri} ({result}). Please check the credentials.")
+        else:
+            # Listen for changes pushed from the server, rather than waiting for the next poll
+            self.entityWindow.mainWindow.startPushUpdates(server)
+            changeCount = 0
+            for change in self.catalogChanges:
+                self.catalogChanges[change] += len(server.entityStatus.changes[change])
+                changeCount += len(server.entityStatus.changes[change])
+            # Update the domains, and the entities listed for the selected domains, only if any entity was added, removed or renamed
+            if changeCount > 0:
+                self.showDomains(servers.domainNames())
+                if len(self.entityWindow.domainEntityIds) > 0:
+                    selectedDomains = set(self.entityTypeModel.selectedNames(self.entityTypeTable))
+                    self.entityWindow.showEntities(servers.entityIdsForDomains(selectedDomains))
+        # Report servers that could not be read in the status bar straight away, so the other windows can still be used
+        if len(self.catalogErrors) > 0:
+            self.statusBar().showMessage(" ".join(self.catalogErrors))
+
+    # Summarise what changed once every server has been read, and read them again if that was asked for in the meantime
+    def entitiesRead(self, results):
+        self.catalogWorker = None
+        servers = self.entityWindow.mainWindow.servers
+        added = self.catalogChanges["added"]
+        removed = self.catalogChanges["removed"]
+        renamed = self.catalogChanges["renamed"]
+        if len(self.catalogErrors) == len(servers):
+            print ("Could not connect to the API")
+        if len(self.catalogErrors) > 0:
+            self.statusBar().showMessage(" ".join(self.catalogErrors))
+        elif added + removed + renamed > 0:
+            self.statusBar().showMessage(f"Entities updated: {added} added, {removed} removed, {renamed} renamed")
+        else:
+            self.statusBar().clearMessage()
+
+        if self.catalogPending:
+            self.catalogPending = False
+            self.refreshEntities()
 
-        except (requests.exceptions.InvalidURL, requests.exceptions.ConnectionError):
-            errorBox = CustomQMessageBox("Connection Error","Invalid URL. Please check the details.")
-        
     # Function to return the entity types that have been selected in the config window and add to a set
     def selectEntityTypes(self):
         entityWindow.show()
 
-        selectedDomains = set()
         # Selected domains
-        for selected in configWindow.entityTypeTable.selectedRanges():
-            for i in range(selected.topRow(), selected.bottomRow()+1):
-                selectedDomains.add(configWindow.entityTypeTable.item(i,0).text())
-
-
-        # Now we need to populate the entities table, which we will do by creating a dictionary that stores the necessary details
-        relevantEntitiesList = []
-        counter = 0
-        for entity in entitiesJson:
-            for domain in selectedDomains:
-                if entity["entity_id"].startswith(domain):
-                    relevantEntitiesList.append(entity["entity_id"])
-                    counter += 1
-        self.entityWindow.entitiesTable.setRowCount(counter)
-        self.entityWindow.entitiesTable.setColumnCount(1)
-
-        # Set the size of the table and configure the table
-        self.entityWindow.entitiesTable.verticalHeader().setVisible(False)
-        self.entityWindow.entitiesTable.horizontalHeader().setVisible(False)
-        header = self.entityWindow.entitiesTable.horizontalHeader()       
-        header.setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
-
-        # Update the label on the entities window
-        self.entityWindow.numEntitiesLabel.setText("Number of Entities: " + str(len(relevantEntitiesList)))
+        selectedDomains = set(self.entityTypeModel.selectedNames(self.entityTypeTable))
 
-        for i in range(0, len(relevantEntitiesList)):
-            self.entityWindow.entitiesTable.setItem(i, 0, QTableWidgetItem(relevantEntitiesList[i]))
+        # Now we need to populate the entities table, looking the entities up in the catalog by domain
+        relevantEntitiesList = self.entityWindow.mainWindow.servers.entityIdsForDomains(selectedDomains)
+        self.entityWindow.showEntities(relevantEntitiesList)
 
 if __name__ == "__main__":
 
@@ -434,15 +1083,44 @@ if __name__ == "__main__":
             uri = config["Server"]["Address"]
         if "Server" in config and "ApiKey" in config["Server"]:
             apiKey = config["Server"]["ApiKey"]
+        applyClientSettings(config)
+        HaMetrics.configure(config)
+        if "History" in config:
+            MainWindow.backfillHours = config["History"].getfloat("BackfillHours", MainWindow.backfillHours)
     else:
         print("Config file does not exist or is incorrectly formatted! You will be asked to enter details next...")
+    # Keep a copy of each server's entities, so they can be listed straight away next time
+    HaEntityStatus.snapshot = HaCatalogSnapshot.fromConfig(config)
+    startupTimer.mark("Read config")
 
     # Create a new application and windows
     app = QApplication(sys.argv)
-    mainWindow = MainWindow()
+    startupTimer.mark("Create QApplication")
+    mainWindow = MainWindow(historyStore = HaHistoryStore.fromConfig(config), scheduler = HaPollScheduler.fromConfig(config), servers = HaServerGroup.fromConfig(config),
+                            statistics = RollingStatistics.fromConfig(config), trendBuffer = TrendBuffer.fromConfig(config))
+    startupTimer.mark("Create main window")
     entityWindow = EntityWindow(mainWindow = mainWindow)    
     configWindow = ConfigWindow(entityWindow = entityWindow, uri = uri, apiKey = apiKey)
+    startupTimer.mark("Create other windows")
+
+    # List the entities saved from last time, so they can be chosen before any server answers
+    configWindow.showSavedEntities()
+    startupTimer.mark("Load saved entities")
+
+    # Carry on tracking the entities from last time, with their recent history
+    mainWindow.restoreHistory()
+    startupTimer.mark("Restore history")
 
     # Open the main window when the program runs and execute the app
     mainWindow.show()
+    startupTimer.mark("Show main window")
+
+    # Read the entities of each configured server again in the background, applying only what has changed
+    if any(server.uri != "" for server in mainWindow.servers):
+        configWindow.refreshEntities()
+    # Report the timings once the event loop has started and the window has had the chance to be drawn
+    def reportStartup():
+        startupTimer.mark("First event loop pass")
+        startupTimer.report()
+    QTimer.singleShot(0, reportStartup)
     app.exec()
\ No newline at end of file
@@ -0,0 +1,218 @@
+#! /usr/bin/python3
+# Check HaWebSocketClient against a stand-in for the Home Assistant WebSocket API running on a local port
+# Run with python3 -m unittest test_haWebSocketClient, or with pytest. Needs the websocket-client library
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+import time
+import unittest
+import importlib.util
+
+from haWebSocketClient import HaWebSocketClient
+
+# Class used to run a stand-in WebSocket API in a background thread. It asks for authentication, accepts one API key,
+# answers a subscription to state changes and then sends whatever events the test pushes
+class HaStubWebSocketServer:
+    # Value used by every WebSocket server to answer the key sent in the handshake
+    handshakeGuid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    #Initialise the class, listening on a free local port
+    def __init__(self, apiKey="test-key"):
+        self.apiKey = apiKey
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.uri = f"http://127.0.0.1:{self.listener.getsockname()[1]}"
+        # Connections that have subscribed to state changes, every message received and the number of connections accepted
+        self.subscribers = []
+        self.received = []
+        self.connectionCount = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.acceptConnections, daemon=True)
+        self.thread.start()
+
+    def acceptConnections(self):
+        while True:
+            try:
+                connection, address = self.listener.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.connectionCount += 1
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    # Answer the HTTP upgrade request, then talk to the client as Home Assistant does
+    def serve(self, connection):
+        try:
+            request = b""
+            while b"\r\n\r\n" not in request:
+                data = connection.recv(4096)
+                if not data:
+                    return
+                request += data
+            headers = {}
+            for line in request.decode().split("\r\n")[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + HaStubWebSocketServer.handshakeGuid).encode()).digest()).decode()
+            connection.sendall(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                                f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+
+            self.sendMessage(connection, {"type": "auth_required"})
+            message = self.receiveMessage(connection)
+            if message == None or message.get("access_token") != self.apiKey:
+                self.sendMessage(connection, {"type": "auth_invalid", "message": "Invalid access token"})
+                return
+            self.sendMessage(connection, {"type": "auth_ok"})
+            message = self.receiveMessage(connection)
+            if message == None or message.get("type") != "subscribe_events":
+                return
+            self.sendMessage(connection, {"id": message["id"], "type": "result", "success": True, "result": None})
+            with self.lock:
+                self.subscribers.append(connection)
+            # Keep the connection open until the client closes it
+            while self.receiveMessage(connection) != None:
+                pass
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                if connection in self.subscribers:
+                    self.subscribers.remove(connection)
+            connection.close()
+
+    # Send an object as a single unmasked text frame
+    def sendMessage(self, connection, message):
+        data = json.dumps(message).encode()
+        if len(data) < 126:
+            header = struct.pack("!BB", 0x81, len(data))
+        elif len(data) < 65536:
+            header = struct.pack("!BBH", 0x81, 126, len(data))
+        else:
+            header = struct.pack("!BBQ", 0x81, 127, len(data))
+        connection.sendall(header + data)
+
+    # Read exactly count bytes, raising ConnectionError if the client goes away first
+    def receiveBytes(self, connection, count):
+        data = b""
+        while len(data) < count:
+            chunk = connection.recv(count - len(data))
+            if not chunk:
+                raise ConnectionError("The client closed the connection")
+            data += chunk
+        return data
+
+    # Read the next text frame from the client and return it as an object, or None when the client closes the connection
+    def receiveMessage(self, connection):
+        while True:
+            first, second = self.receiveBytes(connection, 2)
+            opcode = first & 0x0f
+            length = second & 0x7f
+            if length == 126:
+                length = struct.unpack("!H", self.receiveBytes(connection, 2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", self.receiveBytes(connection, 8))[0]
+            mask = self.receiveBytes(connection, 4) if second & 0x80 else b"\0\0\0\0"
+            payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(self.receiveBytes(connection, length)))
+            if opcode == 0x8:
+                return None
+            if opcode == 0x1:
+                message = json.loads(payload)
+                with self.lock:
+                    self.received.append(message)
+                return message
+
+    # Send a state_changed event to every subscribed client
+    def pushState(self, entityId, state):
+        newState = {"entity_id": entityId, "state": state, "attributes": {}}
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for connection in subscribers:
+            self.sendMessage(connection, {"id": 1, "type": "event", "event": {"event_type": "state_changed", "data": {"entity_id": entityId, "new_state": newState}}})
+
+    # Close every client connection without a closing handshake, as a server that restarts would
+    def dropConnections(self):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for connection in subscribers:
+            connection.shutdown(socket.SHUT_RDWR)
+
+    def stop(self):
+        self.listener.close()
+        self.dropConnections()
+
+# Wait until a condition is true, returning False if it is still false after timeout seconds
+def waitFor(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+@unittest.skipIf(importlib.util.find_spec("websocket") == None, "the websocket-client library is not installed")
+class HaWebSocketClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = HaStubWebSocketServer()
+        self.states = []
+        self.connectionChanges = []
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    # Create and start a client that records what it is told, reconnecting quickly so the tests do not wait long
+    def startClient(self, apiKey="test-key"):
+        self.client = HaWebSocketClient(self.server.uri, apiKey, onStateChanged=lambda entityId, newState: self.states.append((entityId, newState["state"])),
+                                        onConnectionChanged=self.connectionChanges.append, reconnectDelay=0.2, receiveTimeout=0.2)
+        self.client.start()
+
+    def testAuthenticatesAndSubscribes(self):
+        self.startClient()
+        self.assertTrue(waitFor(lambda: len(self.server.subscribers) == 1))
+        self.assertTrue(waitFor(lambda: self.client.connected))
+        self.assertEqual(self.connectionChanges, [True])
+        self.assertEqual(self.server.received[0], {"type": "auth", "access_token": "test-key"})
+        self.assertEqual(self.server.received[1], {"id": 1, "type": "subscribe_events", "event_type": "state_changed"})
+
+    def testPassesOnStateChanges(self):
+        self.startClient()
+        self.assertTrue(waitFor(lambda: self.client.connected and len(self.server.subscribers) == 1))
+        self.server.pushState("sensor.kitchen_temperature", "21.5")
+        self.server.pushState("light.hall", "on")
+        self.assertTrue(waitFor(lambda: len(self.states) == 2))
+        self.assertEqual(self.states, [("sensor.kitchen_temperature", "21.5"), ("light.hall", "on")])
+
+    def testRejectedApiKeyIsNotConnected(self):
+        self.startClient(apiKey="wrong-key")
+        # The client keeps trying, but never reports a connection or subscribes
+        self.assertTrue(waitFor(lambda: self.server.connectionCount >= 2))
+        self.assertFalse(self.client.connected)
+        self.assertEqual(self.connectionChanges, [])
+        self.assertFalse(any(message.get("type") == "subscribe_events" for message in self.server.received))
+
+    def testReconnectsAndSubscribesAgain(self):
+        self.startClient()
+        self.assertTrue(waitFor(lambda: self.client.connected and len(self.server.subscribers) == 1))
+        self.server.dropConnections()
+        self.assertTrue(waitFor(lambda: self.connectionChanges == [True, False, True]))
+        self.assertTrue(waitFor(lambda: len(self.server.subscribers) == 1))
+        self.assertEqual(self.server.connectionCount, 2)
+        # Message ids start again from 1 on the new connection, as Home Assistant expects
+        subscriptions = [message for message in self.server.received if message.get("type") == "subscribe_events"]
+        self.assertEqual([message["id"] for message in subscriptions], [1, 1])
+        self.server.pushState("switch.fan", "off")
+        self.assertTrue(waitFor(lambda: self.states == [("switch.fan", "off")]))
+
+    def testStopClosesTheConnection(self):
+        self.startClient()
+        self.assertTrue(waitFor(lambda: self.client.connected and len(self.server.subscribers) == 1))
+        self.client.stop()
+        self.assertFalse(self.client.thread.is_alive())
+        self.assertEqual(self.connectionChanges, [True, False])
+        self.assertTrue(waitFor(lambda: len(self.server.subscribers) == 0))
+
+if __name__ == "__main__":
+    unittest.main()